@@ -0,0 +1,118 @@
+"""Benchmark the analysis of inline, url and git templates.
+
+The fixture blueprint is served over HTTP from localhost, both as an archive
+and as plain files, and committed to a local Git repository, so that no
+network access is needed. Each template is analyzed with the analysis cache
+in place and after clearing it. Downloads and Git mirrors stay cached, as
+they would between analyses.
+
+    python benchmarks/bench_analyze.py [--mongo-uri URI] [--repeat 3]
+
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import subprocess
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from mist.orchestration import methods
+from mist.orchestration.models import Template, TemplateAnalysis
+
+from common import connect, create_owner, emit, get_parser, measure
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures', 'blueprint')
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory):
+    """Serve `directory` over HTTP in a background thread"""
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def create_archive(path):
+    with tarfile.open(path, 'w:gz') as tar:
+        tar.add(FIXTURES, arcname='blueprint')
+
+
+def create_repository(path):
+    shutil.copytree(FIXTURES, path)
+    for args in (('init', '--quiet'), ('add', '.'),
+                 ('-c', 'user.name=benchmark', '-c', 'user.email=benchmark',
+                  'commit', '--quiet', '-m', 'Add blueprint'),
+                 ('branch', '-M', 'master')):
+        subprocess.check_call(('git', ) + args, cwd=path)
+
+
+def get_templates(owner, tmpdir, base_url):
+    with open(os.path.join(FIXTURES, 'blueprint.yaml')) as fobj:
+        inline = fobj.read().replace('- types.yaml',
+                                     '- %s/types.yaml' % base_url)
+    repository = os.path.join(tmpdir, 'repository')
+    create_repository(repository)
+    fields = {'owner': owner, 'exec_type': 'cloudify'}
+    return [
+        Template(name='inline', location_type='inline', template=inline,
+                 **fields),
+        Template(name='url', location_type='url',
+                 template='%s/blueprint.tar.gz' % base_url,
+                 entrypoint='blueprint.yaml', **fields),
+        Template(name='git', location_type='github',
+                 template='file://%s' % repository,
+                 entrypoint='blueprint.yaml', **fields),
+    ]
+
+
+def run(repeat=3):
+    owner = create_owner()
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        served = os.path.join(tmpdir, 'served')
+        shutil.copytree(FIXTURES, served)
+        create_archive(os.path.join(served, 'blueprint.tar.gz'))
+        server = serve(served)
+        try:
+            base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+            for template in get_templates(owner, tmpdir, base_url):
+                # Warm up the downloads cache and Git mirrors.
+                methods.analyze_template(template)
+                assert 'scale_cluster_up' in [workflow['name'] for workflow
+                                              in template.workflows]
+                seconds, commands = measure(
+                    lambda: methods.analyze_template(template), repeat)
+                results.append({'name': 'analyze_template_cached',
+                                'location_type': template.location_type,
+                                'seconds': seconds, 'commands': commands})
+                seconds, commands = measure(
+                    lambda _: methods.analyze_template(template), repeat,
+                    TemplateAnalysis.objects.delete)
+                results.append({'name': 'analyze_template',
+                                'location_type': template.location_type,
+                                'seconds': seconds, 'commands': commands})
+        finally:
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def main():
+    args = get_parser(__doc__).parse_args()
+    connect(args.mongo_uri)
+    emit('analyze', run(args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark archiving deleted templates and uninstalled stacks.
+
+Each round creates as many uninstalled Stacks as the given size, along with
+ones that must be kept: Stacks that were installed again, whose uninstall
+failed or which were uninstalled recently. Their Templates are deleted.
+The archived resources are checked, besides being timed.
+
+    python benchmarks/bench_archive.py [--mongo-uri URI] [--sizes 10,1000]
+
+"""
+import time
+import uuid
+import datetime
+
+from mist.orchestration import methods
+from mist.orchestration.config import ARCHIVE_RETENTION_DAYS
+from mist.orchestration.models import Template, Stack
+
+from common import connect, create_owner, disable_side_effects, emit
+from common import get_parser, measure, parse_sizes
+
+
+SIZES = '10,1000,10000'
+
+
+def get_workflows(*workflows):
+    return [{'name': name, 'job_id': uuid.uuid4().hex, 'error': error,
+             'timestamp': timestamp}
+            for name, error, timestamp in workflows]
+
+
+def populate(owner, size):
+    """Create `size` archivable Stacks and a Template, and return the ids
+    of the Stacks and Template that are to be archived, as well as the ids
+    of the Stacks that are to be kept"""
+    now = time.time()
+    old = now - (ARCHIVE_RETENTION_DAYS + 1) * 24 * 3600
+    deleted = datetime.datetime.utcnow() - datetime.timedelta(
+        days=ARCHIVE_RETENTION_DAYS + 1)
+    archived = Template(owner=owner, name='archived-%s' % uuid.uuid4().hex,
+                        exec_type='cloudify', location_type='inline',
+                        template='tosca_definitions_version: v1',
+                        deleted=deleted).save()
+    kept = Template(owner=owner, name='kept-%s' % uuid.uuid4().hex,
+                    exec_type='cloudify', location_type='inline',
+                    template='tosca_definitions_version: v1',
+                    deleted=deleted).save()
+    uninstalled = [
+        Stack(owner=owner, name='uninstalled-%s' % uuid.uuid4().hex,
+              template=archived, status='ok',
+              workflows=get_workflows(('install', False, old - 60),
+                                      ('uninstall', False, old)))
+        for _ in range(size)]
+    kept_stacks = [
+        Stack(owner=owner, name='reinstalled-%s' % uuid.uuid4().hex,
+              template=kept, status='ok',
+              workflows=get_workflows(('uninstall', False, old),
+                                      ('install', False, now))),
+        Stack(owner=owner, name='failed-%s' % uuid.uuid4().hex,
+              template=kept, status='error',
+              workflows=get_workflows(('uninstall', True, old))),
+        Stack(owner=owner, name='recent-%s' % uuid.uuid4().hex,
+              template=kept, status='ok',
+              workflows=get_workflows(('uninstall', False, now))),
+    ]
+    Stack.objects.insert(uninstalled + kept_stacks, load_bulk=False)
+    return ({stack.id for stack in uninstalled}, archived.id,
+            {stack.id for stack in kept_stacks})
+
+
+def run(repeat=3, sizes=SIZES):
+    disable_side_effects()
+    results = []
+    for size in parse_sizes(sizes):
+        owner = create_owner()
+        expected = []
+
+        def setup():
+            expected.append(populate(owner, size))
+
+        seconds, commands = measure(lambda _: methods.archive_deleted(),
+                                    repeat, setup)
+        for stack_ids, template_id, kept_ids in expected:
+            assert not Stack.objects(id__in=list(stack_ids)).count()
+            assert not Template.objects(id=template_id).count()
+            assert Stack.objects(id__in=list(kept_ids)).count() == \
+                len(kept_ids)
+        results.append({'name': 'archive_deleted', 'size': size,
+                        'seconds': seconds, 'commands': commands})
+    return results
+
+
+def main():
+    args = get_parser(__doc__, SIZES).parse_args()
+    connect(args.mongo_uri)
+    emit('archive', run(args.repeat, args.sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark the list endpoints against the number of listed resources.
+
+    python benchmarks/bench_list.py [--mongo-uri URI] [--sizes 10,1000]
+
+"""
+from mist.api.tag.models import Tag
+
+from mist.orchestration import methods
+from mist.orchestration.models import Template, Stack
+
+from common import FakeAuthContext
+from common import connect, create_owner, emit, get_parser, measure
+from common import parse_sizes
+
+
+def populate(owner, size, tags=2):
+    """Create `size` Templates and Stacks, each with `tags` tags"""
+    templates = [Template(owner=owner, name='template-%d' % i,
+                          exec_type='cloudify', location_type='inline',
+                          template='tosca_definitions_version: v1')
+                 for i in range(size)]
+    stacks = [Stack(owner=owner, name='stack-%d' % i, status='ok',
+                    template=templates[i])
+              for i in range(size)]
+    Template.objects.insert(templates, load_bulk=False)
+    Stack.objects.insert(stacks, load_bulk=False)
+    Tag.objects.insert([
+        Tag(owner=owner, resource_type=rtype, resource_id=resource.id,
+            key='key-%d' % j, value='value-%d' % j)
+        for rtype, resources in (('template', templates), ('stack', stacks))
+        for resource in resources for j in range(tags)
+    ], load_bulk=False)
+
+
+SIZES = '10,1000,10000'
+
+
+def run(repeat=3, sizes=SIZES):
+    results = []
+    for size in parse_sizes(sizes):
+        auth_context = FakeAuthContext(create_owner())
+        populate(auth_context.owner, size)
+        for func in (methods.filter_list_templates,
+                     methods.filter_list_stacks):
+            seconds, commands = measure(lambda: func(auth_context), repeat)
+            results.append({'name': func.__name__, 'size': size,
+                            'seconds': seconds, 'commands': commands})
+        filters = {'status': 'ok', 'tags': {'key-0': 'value-0'},
+                   'name_prefix': 'stack-1'}
+        seconds, commands = measure(
+            lambda: methods.filter_list_stacks(auth_context,
+                                               filters=filters), repeat)
+        results.append({'name': 'filter_list_stacks_filtered', 'size': size,
+                        'seconds': seconds, 'commands': commands})
+    return results
+
+
+def main():
+    args = get_parser(__doc__, SIZES).parse_args()
+    connect(args.mongo_uri)
+    emit('list', run(args.repeat, args.sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark the serialization and validation of Stacks and form_inputs.
+
+Stacks are measured against the number of their node instances and
+form_inputs against the number of inputs.
+
+    python benchmarks/bench_models.py [--mongo-uri URI] [--sizes 10,1000]
+
+"""
+import uuid
+
+from mist.orchestration import methods
+from mist.orchestration.models import Template, Stack
+
+from common import connect, create_owner, emit, get_parser, measure
+from common import parse_sizes
+
+
+SIZES = '10,100,1000,10000'
+
+
+def create_cloud(owner):
+    from mist.api.clouds.models import OtherCloud
+    return OtherCloud(owner=owner,
+                      title='benchmark-%s' % uuid.uuid4().hex).save()
+
+
+def get_node_instances(cloud, size):
+    """Return `size` node instances, each of a separate machine"""
+    return [{'id': 'worker_%d' % i, 'node_id': 'worker', 'state': 'started',
+             'runtime_properties': {'cloud_id': cloud.id,
+                                    'machine_id': 'machine-%d' % i,
+                                    'ip': '10.0.%d.%d' % (i // 256, i % 256)}}
+            for i in range(size)]
+
+
+def get_inputs(size):
+    """Return `size` blueprint inputs"""
+    inputs = {'input_%d' % i: {'description': 'Input %d' % i,
+                               'default': 'value-%d' % i}
+              for i in range(size)}
+    inputs['mist_token'] = {'default': ''}
+    return inputs
+
+
+def run(repeat=3, sizes=SIZES):
+    owner = create_owner()
+    cloud = create_cloud(owner)
+    template = Template(owner=owner, name='template-%s' % uuid.uuid4().hex,
+                        exec_type='cloudify', location_type='inline',
+                        template='tosca_definitions_version: v1').save()
+    results = []
+    for size in parse_sizes(sizes):
+        node_instances = get_node_instances(cloud, size)
+
+        def new_stack():
+            return Stack(owner=owner, name='stack-%s' % uuid.uuid4().hex,
+                         template=template, status='ok', deploy=True,
+                         node_instances=node_instances)
+
+        # Machines are resolved, and inserted on first use, when validating
+        # new Stacks and whenever their node instances change.
+        stack = new_stack().save()
+        seconds, commands = measure(Stack.clean, repeat, new_stack)
+        results.append({'name': 'Stack.clean', 'size': size,
+                        'seconds': seconds, 'commands': commands})
+
+        seconds, commands = measure(stack.as_dict, repeat)
+        results.append({'name': 'Stack.as_dict', 'size': size,
+                        'seconds': seconds, 'commands': commands})
+
+        seconds, commands = measure(
+            lambda: Stack.objects.get(id=stack.id).as_dict(), repeat)
+        results.append({'name': 'Stack.as_dict_loaded', 'size': size,
+                        'seconds': seconds, 'commands': commands})
+
+        inputs = get_inputs(size)
+        seconds, _ = measure(lambda: methods.form_inputs(inputs), repeat)
+        results.append({'name': 'form_inputs', 'size': size,
+                        'seconds': seconds, 'commands': None})
+    return results
+
+
+def main():
+    args = get_parser(__doc__, SIZES).parse_args()
+    connect(args.mongo_uri)
+    emit('models', run(args.repeat, args.sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Benchmark queueing, dispatching workflows and recording their outcome.
+
+Stacks are measured against the number of their node instances. The outcome
+of workflows is reported either with the full list of node instances or with
+just the one that changed. Dispatching is measured against the number of
+queued workflows, spread over as many owners as needed for the overall
+limit of running workflows to be reached. Docker, logging and session
+updates are stubbed out.
+
+    python benchmarks/bench_workflows.py [--mongo-uri URI] [--sizes 10,100]
+
+"""
+from mist.orchestration import methods
+from mist.orchestration.config import MAX_RUNNING_WORKFLOWS
+from mist.orchestration.config import MAX_RUNNING_WORKFLOWS_PER_OWNER
+from mist.orchestration.models import WorkflowRun
+
+from bench_writes import create_stack
+
+from common import FakeAuthContext
+from common import connect, create_owner, create_user, disable_side_effects
+from common import emit, get_parser, measure, parse_sizes
+
+
+SIZES = '10,100,1000'
+
+
+def queue_workflows(size):
+    """Queue `size` workflows and return the owners of their Stacks"""
+    # Runs queued by other benchmarks would be dispatched as well. The
+    # database is a disposable one.
+    WorkflowRun.drop_collection()
+    # Enough owners for the overall limit to be reached.
+    owners = [create_owner() for _ in range(
+        MAX_RUNNING_WORKFLOWS // MAX_RUNNING_WORKFLOWS_PER_OWNER + 1)]
+    user = create_user()
+    for i, owner in enumerate(owners):
+        auth_context = FakeAuthContext(owner, user)
+        stacks = [create_stack(owner, 1)
+                  for _ in range(i, size, len(owners))]
+        if stacks:
+            methods.run_workflows(auth_context, stacks, 'scale',
+                                  [{'delta': 1}] * len(stacks))
+    return owners
+
+
+def requeue_workflows():
+    """Queue the started workflows again, so that each dispatch does the
+    same work"""
+    WorkflowRun.objects(status='running').update(
+        set__status='queued', unset__started_at=True,
+        unset__container_id=True)
+
+
+def run(repeat=3, sizes=SIZES):
+    disable_side_effects()
+    results = []
+    for size in parse_sizes(sizes):
+        auth_context = FakeAuthContext(create_owner())
+        stack = create_stack(auth_context.owner, size)
+        node_instances = stack.node_instances
+
+        def run_workflow():
+            return methods.run_workflow(auth_context, stack, 'scale',
+                                        {'delta': 1})
+
+        def rerun_workflow():
+            # finish_workflow bumps the version of the Stack in the database
+            # only, which run_workflow expects to match the loaded one.
+            stack.reload()
+            return run_workflow()
+
+        seconds, commands = measure(run_workflow, repeat)
+        results.append({'name': 'run_workflow', 'size': size,
+                        'seconds': seconds, 'commands': commands})
+
+        def finish_full(job_id):
+            methods.finish_workflow(stack, job_id, 'scale', 0, 'done', False,
+                                    node_instances=node_instances)
+
+        def finish_updated(job_id):
+            updated = dict(node_instances[0], state='stopped')
+            methods.finish_workflow(stack, job_id, 'scale', 0, 'done', False,
+                                    updated_node_instances=[updated])
+
+        for func in (finish_full, finish_updated):
+            seconds, commands = measure(func, repeat, rerun_workflow)
+            results.append({'name': 'finish_workflow_%s' %
+                            func.__name__.split('_')[1], 'size': size,
+                            'seconds': seconds, 'commands': commands})
+
+        queue_workflows(size)
+        started = []
+        seconds, commands = measure(
+            lambda _: started.append(methods.dispatch_workflows()),
+            repeat, requeue_workflows)
+        assert all(count == min(size, MAX_RUNNING_WORKFLOWS)
+                   for count in started), started
+        results.append({'name': 'dispatch_workflows', 'size': size,
+                        'seconds': seconds, 'commands': commands,
+                        'started': started[-1]})
+    return results
+
+
+def main():
+    args = get_parser(__doc__, SIZES).parse_args()
+    connect(args.mongo_uri)
+    emit('workflows', run(args.repeat, args.sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark the Mongo writes of launching a workflow on a Stack.
+
+Compares `methods.run_workflow`, which sets the changed fields atomically,
+with saving the whole Stack, which is what it used to do, for Stacks with a
+growing number of node instances. Write bytes are only reported when
+running against a real mongod.
+
+    python benchmarks/bench_writes.py [--mongo-uri URI] [--sizes 10,100]
+
+"""
+import uuid
+
+from mist.orchestration import methods
+from mist.orchestration.models import Template, Stack
+
+from common import FakeAuthContext
+from common import connect, create_owner, disable_tasks, emit, get_parser
+from common import measure, measure_writes, parse_sizes
+
+
+def create_stack(owner, size):
+    """Create an installed Stack with `size` node instances"""
+    template = Template(owner=owner, name='template-%s' % uuid.uuid4().hex,
+                        exec_type='cloudify', location_type='inline',
+                        template='tosca_definitions_version: v1').save()
+    node_instances = [{'id': 'node_%d' % i, 'node_id': 'node',
+                       'state': 'started',
+                       'runtime_properties': {'index': i, 'ip': '10.0.0.1'}}
+                      for i in range(size)]
+    return Stack(owner=owner, name='stack-%s' % uuid.uuid4().hex,
+                 template=template, status='ok', deploy=True,
+                 node_instances=node_instances).save()
+
+
+def launch_with_save(auth_context, stack):
+    """Launch a workflow the way run_workflow did, by saving the Stack"""
+    stack.inputs.update({'scale': {'delta': 1}})
+    stack.job_id = uuid.uuid4().hex
+    stack.status = 'queued'
+    # Stack.clean used to resolve the machines on every save.
+    stack.resolve_machines(stack.node_instances)
+    stack.save()
+    methods.WorkflowRun(job_id=stack.job_id, owner=stack.owner, stack=stack,
+                        user=auth_context.user, workflow='scale',
+                        inputs={'delta': 1}).save()
+
+
+def launch_atomically(auth_context, stack):
+    methods.run_workflow(auth_context, stack, 'scale', {'delta': 1})
+
+
+SIZES = '10,100,1000'
+
+
+def run(repeat=3, sizes=SIZES):
+    disable_tasks()
+    results = []
+    for size in parse_sizes(sizes):
+        auth_context = FakeAuthContext(create_owner())
+        for func in (launch_with_save, launch_atomically):
+            stack = create_stack(auth_context.owner, size)
+            seconds, _ = measure(lambda: func(auth_context, stack), repeat)
+            commands, write_bytes = measure_writes(
+                lambda: func(auth_context, stack), repeat)
+            results.append({'name': func.__name__, 'size': size,
+                            'seconds': seconds, 'commands': commands,
+                            'write_bytes': write_bytes})
+    return results
+
+
+def main():
+    args = get_parser(__doc__, SIZES).parse_args()
+    connect(args.mongo_uri)
+    emit('writes', run(args.repeat, args.sizes))
+
+
+if __name__ == '__main__':
+    main()
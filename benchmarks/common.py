@@ -0,0 +1,177 @@
+"""Shared helpers of the orchestration benchmarks.
+
+The benchmarks need an environment where `mist.api` is importable. They run
+against mongomock by default, so that no database is required. Pass
+`--mongo-uri` to run them against a real (and disposable) mongod instead, in
+which case the number of Mongo round trips is reported as well. Each
+`bench_*.py` script may be run on its own, or all of them at once by means of
+`run.py`.
+
+"""
+import sys
+import json
+import time
+import uuid
+import argparse
+
+import bson
+import mongoengine as me
+
+from pymongo import monitoring
+
+import mist.api  # noqa: F401
+
+
+WRITE_COMMANDS = ('insert', 'update', 'delete', 'findAndModify')
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Count the commands sent to mongod and the bytes of the writes"""
+
+    def __init__(self):
+        self.enabled = False
+        self.count = 0
+        self.write_bytes = 0
+
+    def started(self, event):
+        self.count += 1
+        if event.command_name in WRITE_COMMANDS:
+            self.write_bytes += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+COMMANDS = CommandCounter()
+
+
+class FakeAuthContext(object):
+    """An AuthContext of an Owner, who is allowed to do anything"""
+
+    def __init__(self, owner, user=None):
+        self.owner = self.org = owner
+        self.user = user
+
+    def is_owner(self):
+        return True
+
+    def check_perm(self, rtype, action, rid):
+        return {}, {}
+
+    def get_allowed_resources(self, action='read', rtype=None):
+        return []
+
+
+class FakeContainer(object):
+    """A container, as returned by mist.api's `docker_run`"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+
+
+def get_parser(description, sizes=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--mongo-uri', default='',
+                        help='Run against a real mongod, instead of mongomock')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to repeat each measurement')
+    if sizes:
+        parser.add_argument('--sizes', default=sizes, type=parse_sizes,
+                            help='Comma-separated sizes to measure')
+    return parser
+
+
+def parse_sizes(sizes):
+    if isinstance(sizes, str):
+        sizes = sizes.split(',')
+    return [int(size) for size in sizes]
+
+
+def connect(mongo_uri=''):
+    """Connect to a throwaway database"""
+    me.disconnect()
+    COMMANDS.enabled = bool(mongo_uri)
+    if mongo_uri:
+        me.connect(host=mongo_uri, event_listeners=[COMMANDS])
+    elif me.VERSION >= (0, 27):
+        # mongomock:// URIs are no longer supported.
+        import mongomock
+        me.connect('orchestration-benchmarks', host='mongodb://localhost',
+                   mongo_client_class=mongomock.MongoClient)
+    else:
+        me.connect(host='mongomock://localhost/orchestration-benchmarks')
+
+
+def create_owner():
+    from mist.api.users.models import Organization
+    return Organization(name='benchmark-%s' % uuid.uuid4().hex).save()
+
+
+def create_user():
+    from mist.api.users.models import User
+    return User(email='benchmark-%s@example.com' % uuid.uuid4().hex).save()
+
+
+def measure(func, repeat=3, setup=None):
+    """Return the best wall time of `repeat` calls and the commands issued
+
+    If `setup` is given, it is called before each call, outside of the
+    measurement, and its return value is passed to `func`. The number of
+    commands is None, unless running against a real mongod.
+
+    """
+    timings = []
+    commands = 0
+    for _ in range(repeat):
+        args = () if setup is None else (setup(), )
+        count = COMMANDS.count
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+        commands += COMMANDS.count - count
+    if not COMMANDS.enabled:
+        return min(timings), None
+    return min(timings), commands // repeat
+
+
+def measure_writes(func, repeat=3):
+    """Return the average commands and write bytes of `repeat` calls
+
+    Both are None, unless running against a real mongod.
+
+    """
+    commands, write_bytes = COMMANDS.count, COMMANDS.write_bytes
+    for _ in range(repeat):
+        func()
+    if not COMMANDS.enabled:
+        return None, None
+    return ((COMMANDS.count - commands) // repeat,
+            (COMMANDS.write_bytes - write_bytes) // repeat)
+
+
+def disable_tasks():
+    """Do not send any messages to the dramatiq broker"""
+    from mist.orchestration import tasks
+    for name in tasks.__all__:
+        actor = getattr(tasks, name)
+        actor.send = actor.send_with_options = lambda *args, **kwargs: None
+
+
+def disable_side_effects():
+    """Stub out Docker, logging and session updates, besides tasks"""
+    from mist.api import helpers
+    from mist.orchestration import methods
+    disable_tasks()
+    # start_workflow reads the id of the container and the time of the event.
+    methods.docker_run = lambda *args, **kwargs: FakeContainer()
+    methods.log_event = lambda *args, **kwargs: {'time': time.time()}
+    helpers.trigger_session_update = lambda *args, **kwargs: None
+
+
+def emit(benchmark, results, stream=sys.stdout):
+    """Write the results of a benchmark as JSON"""
+    json.dump({'benchmark': benchmark, 'results': results}, stream, indent=2)
+    stream.write('\n')
@@ -0,0 +1,93 @@
+"""Run the orchestration benchmarks and write their results as JSON.
+
+    python benchmarks/run.py [--mongo-uri URI] [--only list,models]
+                             [--output results.json]
+                             [--baseline previous.json] [--threshold 1.25]
+
+Results are keyed by benchmark. With `--baseline`, the results of an earlier
+run, any measurement slower than `--threshold` times its baseline is listed
+in `regressions` and the script exits with status 1.
+
+"""
+import sys
+import json
+import platform
+import datetime
+import importlib
+
+from common import connect, get_parser
+
+
+BENCHMARKS = ('list', 'writes', 'models', 'analyze', 'workflows', 'archive')
+
+
+def get_key(benchmark, result):
+    return (benchmark, ) + tuple(sorted(
+        (key, value) for key, value in result.items()
+        if key in ('name', 'size', 'location_type')))
+
+
+def find_regressions(report, baseline, threshold):
+    """Return the results of `report` slower than `threshold` times their
+    baseline"""
+    previous = {get_key(benchmark, result): result
+                for benchmark, results in baseline['benchmarks'].items()
+                for result in results}
+    regressions = []
+    for benchmark, results in report['benchmarks'].items():
+        for result in results:
+            before = previous.get(get_key(benchmark, result))
+            if not before or not before.get('seconds'):
+                continue
+            ratio = result['seconds'] / before['seconds']
+            if ratio > threshold:
+                regressions.append(dict(result, benchmark=benchmark,
+                                        baseline=before['seconds'],
+                                        ratio=round(ratio, 2)))
+    return regressions
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument('--only', default=','.join(BENCHMARKS),
+                        help='Comma-separated benchmarks to run')
+    parser.add_argument('--output', default='',
+                        help='Write the results to this file')
+    parser.add_argument('--baseline', default='',
+                        help='Compare the results to the ones in this file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Slowdown over the baseline to report')
+    args = parser.parse_args()
+    connect(args.mongo_uri)
+
+    report = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'database': 'mongod' if args.mongo_uri else 'mongomock',
+        'repeat': args.repeat,
+        'benchmarks': {},
+    }
+    for name in args.only.split(','):
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: %s' % name)
+        module = importlib.import_module('bench_%s' % name)
+        print('Running %s' % name, file=sys.stderr)
+        report['benchmarks'][name] = module.run(args.repeat)
+
+    if args.baseline:
+        with open(args.baseline) as fobj:
+            report['regressions'] = find_regressions(report, json.load(fobj),
+                                                     args.threshold)
+
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
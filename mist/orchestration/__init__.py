@@ -2,5 +2,38 @@ def add_routes(pyramid_config):
 
     pyramid_config.add_route('api_v1_templates', '/api/v1/templates')
     pyramid_config.add_route('api_v1_template', '/api/v1/templates/{template_id}')
+    pyramid_config.add_route('api_v1_template_git',
+                             '/api/v1/templates/{template_id}/git/*subpath')
+    pyramid_config.add_route('api_v1_template_stacks',
+                             '/api/v1/templates/{template_id}/stacks')
     pyramid_config.add_route('api_v1_stacks', '/api/v1/stacks')
+    # Must precede api_v1_stack, which would match it as well.
+    pyramid_config.add_route('api_v1_stacks_workflows',
+                             '/api/v1/stacks/workflows')
     pyramid_config.add_route('api_v1_stack', '/api/v1/stacks/{stack_id}')
+    pyramid_config.add_route('api_v1_stack_workflows',
+                             '/api/v1/stacks/{stack_id}/workflows')
+    # Core mist.api already serves log stories under /api/v1/jobs.
+    pyramid_config.add_route('api_v1_orchestration_jobs',
+                             '/api/v1/orchestration/jobs')
+    pyramid_config.add_route('api_v1_orchestration_job',
+                             '/api/v1/orchestration/jobs/{job_id}')
+    pyramid_config.add_route('api_v1_orchestration_job_output',
+                             '/api/v1/orchestration/jobs/{job_id}/output')
+
+
+def add_schedules(schedule):
+    """Add the periodic tasks of the plugin to mist.api's schedule"""
+    from mist.orchestration.config import SCHEDULE
+    schedule.update(SCHEDULE)
+
+
+def migrate():
+    """Apply the pending one-off migrations of the plugin's data.
+
+    Must be called on upgrade, before any requests are served or tasks are
+    run. Return the names of the migrations applied.
+
+    """
+    from mist.orchestration.migrations import migrate
+    return migrate()
@@ -1 +1,121 @@
+import os
+import datetime
+import tempfile
+
 CLOUDIFY_MIST_PLUGIN_IMAGE = "mist/cloudify-mist-plugin:latest"
+# The ENTRYPOINT of the image above. It is invoked explicitly, when running
+# workflows in pooled containers.
+CLOUDIFY_MIST_PLUGIN_ENTRYPOINT = ["/entrypoint.sh"]
+
+# Number of idle containers of the image above kept running, so that
+# workflows need not wait for a container to be created. Each pooled
+# container is used for a single workflow. Set to 0 to disable the pool.
+WORKFLOW_CONTAINER_POOL_SIZE = 0
+# The command that keeps pooled containers running, while idle.
+WORKFLOW_CONTAINER_IDLE_COMMAND = ["sleep", "infinity"]
+
+# Maximum number of template analysis results kept in the cache. The least
+# recently used entries are evicted first. Set to 0 to disable the cache.
+TEMPLATE_ANALYSIS_CACHE_SIZE = 1000
+
+# Local directory, where files used to analyze templates are cached.
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "mist-orchestration")
+
+# Local directory with bare mirrors of the Git repositories of templates. It
+# is used when analyzing templates and, if GIT_MIRROR_SERVE is set, workflow
+# containers clone templates out of it, through the API, as well. Set to an
+# empty string to always clone repositories from their origin.
+GIT_MIRRORS_DIR = os.path.join(CACHE_DIR, "git")
+GIT_MIRROR_SERVE = True
+# Minimum number of seconds between fetches from the origin of a mirror.
+GIT_MIRROR_MAX_AGE = 60
+
+# Local directory, where the archives of url templates are cached. Cached
+# archives are revalidated with conditional requests, based on their ETag and
+# Last-Modified headers. The least recently used archives are evicted, once
+# the cache exceeds DOWNLOADS_CACHE_SIZE bytes. Set to an empty string to
+# disable the cache.
+DOWNLOADS_DIR = os.path.join(CACHE_DIR, "downloads")
+DOWNLOADS_CACHE_SIZE = 512 * 1024 * 1024
+
+# Files imported by blueprints, such as the Cloudify and Mist plugin types,
+# are cached in DOWNLOADS_DIR as well, since nearly all blueprints import the
+# same, versioned URLs. They are revalidated at most every IMPORTS_MAX_AGE
+# seconds and their cached copy is used, if their host is unreachable.
+IMPORTS_MAX_AGE = 24 * 3600
+# Rules for rewriting the URLs of imports before fetching them, eg to point
+# them to a local mirror, as a list of {prefix: replacement} dicts.
+IMPORT_RESOLVER_RULES = []
+
+# Number of stacks or templates read from Mongo and tagged at a time, when
+# listing them.
+LIST_BATCH_SIZE = 500
+
+# Maximum number of workflow containers running at the same time, overall and
+# per owner. Any more workflows are queued, until running ones finish.
+MAX_RUNNING_WORKFLOWS = 20
+MAX_RUNNING_WORKFLOWS_PER_OWNER = 5
+
+# Number of recent workflow runs summarized in each Stack. Older runs are only
+# kept in the WorkflowRun collection.
+STACK_WORKFLOWS_SUMMARY_SIZE = 10
+
+# Maximum number of characters of workflow output stored in a single chunk.
+# Larger pieces of output are split.
+WORKFLOW_OUTPUT_CHUNK_SIZE = 64 * 1024
+# Seconds after which clients tailing the output of a running workflow are
+# advised to poll for more, resuming from the last offset they received.
+WORKFLOW_OUTPUT_POLL_INTERVAL = 1
+# Seconds after which stored workflow output expires.
+WORKFLOW_OUTPUT_TTL = 30 * 24 * 3600
+
+# Seconds after which a running workflow, which has not reported back, is
+# considered lost and stops counting against the concurrency limits. Workflows
+# are also considered lost, as soon as their container is found to have
+# exited, which is checked every minute.
+WORKFLOW_RUN_TIMEOUT = 4 * 3600
+
+# Lifetime in seconds of the API tokens passed to workflow containers. Tokens
+# are reused by workflows of the same stack, user and setuid flag, during the
+# first WORKFLOW_TOKEN_REUSE_PERIOD seconds of their lifetime, so that each
+# workflow gets a token valid for at least an hour. Expired tokens are
+# deleted periodically.
+WORKFLOW_TOKEN_TTL = 2 * 3600
+WORKFLOW_TOKEN_REUSE_PERIOD = 3600
+
+# Days after which deleted templates and stacks are moved to the
+# `template_archive` and `stack_archive` collections, in batches of
+# ARCHIVE_BATCH_SIZE. Templates are only archived, once none of their stacks
+# is left. Set to 0 to keep deleted templates and stacks forever.
+ARCHIVE_RETENTION_DAYS = 30
+ARCHIVE_BATCH_SIZE = 1000
+
+# Seconds during which session updates triggered for an Owner are merged into
+# one, so that clients re-fetch stacks and templates at most once per window.
+# Set to 0 to send every session update right away.
+SESSION_UPDATE_DEBOUNCE = 1
+
+# Periodic tasks of the orchestration plugin, in the format of mist.api's
+# schedule. See `mist.orchestration.add_schedules`.
+SCHEDULE = {
+    'orchestration-dispatch-workflows': {
+        'task': 'mist.orchestration.tasks.dispatch_workflows',
+        'schedule': datetime.timedelta(minutes=1),
+    },
+    'orchestration-reap-workflow-runs': {
+        'task': 'mist.orchestration.tasks.reap_workflow_runs',
+        'schedule': datetime.timedelta(minutes=1),
+    },
+    'orchestration-refill-container-pool': {
+        'task': 'mist.orchestration.tasks.refill_container_pool',
+        'schedule': datetime.timedelta(minutes=1),
+    },
+    'orchestration-reap-workflow-tokens': {
+        'task': 'mist.orchestration.tasks.reap_workflow_tokens',
+        'schedule': datetime.timedelta(minutes=10),
+    },
+    'orchestration-archive-deleted': {
+        'task': 'mist.orchestration.tasks.archive_deleted',
+        'schedule': datetime.timedelta(hours=1),
+    },
+}
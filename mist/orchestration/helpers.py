@@ -1,6 +1,17 @@
 import os
+import time
 import glob
 import copy
+import json
+import fcntl
+import shutil
+import fnmatch
+import posixpath
+import base64
+import hashlib
+import tempfile
+import contextlib
+import subprocess
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -8,7 +19,20 @@ import tarfile
 import zipfile
 import logging
 
+import yaml
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.resolver import Resolver
+
+from dsl_parser.exceptions import DSLParsingLogicException
+from dsl_parser.import_resolver.default_import_resolver import \
+    DefaultImportResolver
+
 from mist.api import config
+from mist.api.helpers import docker_connect
+
+from mist.orchestration.config import GIT_MIRRORS_DIR, GIT_MIRROR_MAX_AGE
+from mist.orchestration.config import DOWNLOADS_DIR, DOWNLOADS_CACHE_SIZE
 
 logging.basicConfig(level=config.PY_LOG_LEVEL,
                     format=config.PY_LOG_FORMAT,
@@ -16,14 +40,285 @@ logging.basicConfig(level=config.PY_LOG_LEVEL,
 log = logging.getLogger(__name__)
 
 
-def download(url, path=None):
-    """Download a file over HTTP"""
-    log.debug("Downloading %s.", url)
-    name, headers = urllib.request.urlretrieve(url, path)
-    log.debug("Downloaded to %s.", name)
+def download(url, path=None, max_age=0, stale_on_error=False):
+    """Download a file over HTTP
+
+    If DOWNLOADS_DIR is set, the file is stored in the downloads cache and
+    the path of the cached file, which must not be modified, is returned. A
+    cached file is only downloaded again, if it has changed. It is not even
+    revalidated for `max_age` seconds after it was last validated. If
+    `stale_on_error` is set, the cached file is returned, when revalidating
+    it fails.
+
+    Otherwise, the file is downloaded to `path`, if specified, or to a new
+    temporary file.
+
+    """
+    if not DOWNLOADS_DIR:
+        log.debug("Downloading %s.", url)
+        name, headers = urllib.request.urlretrieve(url, path)
+        log.debug("Downloaded to %s.", name)
+        return name
+
+    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+    name = os.path.join(DOWNLOADS_DIR,
+                        hashlib.sha256(url.encode()).hexdigest())
+    with file_lock(name + '.lock'):
+        headers = {}
+        if os.path.isfile(name) and os.path.isfile(name + '.json'):
+            with open(name + '.json') as fobj:
+                headers = json.load(fobj)
+        if headers and \
+                time.time() - headers.get('validated_at', 0) < max_age:
+            log.debug("Using %s, cached in %s.", url, name)
+            os.utime(name)
+            return name
+        request = urllib.request.Request(url)
+        if headers.get('etag'):
+            request.add_header('If-None-Match', headers['etag'])
+        if headers.get('last_modified'):
+            request.add_header('If-Modified-Since', headers['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                log.debug("Downloading %s.", url)
+                digest = _download_part(response, name)
+                headers = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'sha256': digest,
+                }
+                log.debug("Downloaded to %s.", name)
+        except urllib.error.HTTPError as exc:
+            if exc.code != 304 or not headers:
+                raise
+            log.debug("%s has not been modified since cached in %s.",
+                      url, name)
+        except (urllib.error.URLError, OSError) as exc:
+            if not stale_on_error or not headers:
+                raise
+            log.warning("Failed to revalidate %s, using the copy cached in "
+                        "%s: %r", url, name, exc)
+            os.utime(name)
+            return name
+        # The URL itself is not stored, since it may include credentials.
+        headers['validated_at'] = time.time()
+        with open(name + '.json', 'w') as fobj:
+            json.dump(headers, fobj)
+        os.utime(name)
+    evict_downloads()
     return name
 
 
+def _download_part(response, name):
+    """Write `response` to a temporary file and move it to `name`, once its
+    contents have been verified. Return their SHA-256 hex digest.
+
+    Contents are verified against the Content-Length and the Content-MD5
+    headers of the response, if the server sent them.
+
+    """
+    digest = hashlib.sha256()
+    content_md5 = response.headers.get('Content-MD5')
+    md5 = hashlib.md5() if content_md5 else None
+    # Every download gets a file of its own, so writers never share one.
+    fd, part = tempfile.mkstemp(dir=DOWNLOADS_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as fobj:
+            for chunk in iter(lambda: response.read(64 * 1024), b''):
+                digest.update(chunk)
+                if md5 is not None:
+                    md5.update(chunk)
+                fobj.write(chunk)
+        length = response.headers.get('Content-Length')
+        if length and int(length) != os.path.getsize(part):
+            raise Exception("Incomplete download to %s." % name)
+        if md5 is not None and \
+                base64.b64encode(md5.digest()).decode() != content_md5.strip():
+            raise Exception("Corrupt download to %s." % name)
+        os.replace(part, name)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(part)
+    return digest.hexdigest()
+
+
+def evict_downloads(grace=60):
+    """Evict the least recently used files of the downloads cache
+
+    Files are removed until the cache fits in DOWNLOADS_CACHE_SIZE bytes.
+    Files used during the last `grace` seconds are never removed, since
+    they may be in use, and neither are files that are being downloaded.
+    Lock files are kept, so that they keep serializing downloads.
+
+    """
+    files = []
+    now = time.time()
+    for entry in os.scandir(DOWNLOADS_DIR):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        if '.' not in entry.name:
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        elif entry.name.endswith('.part') and now - stat.st_mtime > 3600:
+            # Left behind by an interrupted download.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+    size = sum(fsize for _, fsize, _ in files)
+    for mtime, fsize, path in sorted(files):
+        if size <= DOWNLOADS_CACHE_SIZE or now - mtime < grace:
+            break
+        with open(path + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                log.debug("Evicting %s from the downloads cache.", path)
+                for suffix in ('', '.json'):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path + suffix)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        size -= fsize
+
+
+def get_file_digest(path):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_git_revision(repo, branch):
+    """Return the commit SHA a remote branch points to, without cloning
+
+    An empty string is returned if the remote cannot be queried.
+
+    """
+    try:
+        output = subprocess.check_output(['git', 'ls-remote', repo, branch],
+                                         stderr=subprocess.DEVNULL,
+                                         timeout=30)
+    except (OSError, subprocess.SubprocessError) as exc:
+        log.warning("Failed to resolve branch '%s' of git repo: %r",
+                    branch, exc)
+        return ''
+    for line in output.decode().splitlines():
+        sha, ref = line.split('\t', 1)
+        if ref in (branch, 'refs/heads/%s' % branch, 'refs/tags/%s' % branch):
+            return sha
+    return ''
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path` across processes"""
+    with open(path, 'a') as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+def _git(action, *args):
+    """Run a git command and return its output
+
+    The error raised on failure does not include the command's output,
+    since it may contain the credentials of the repository's URL.
+
+    """
+    try:
+        return subprocess.check_output(('git',) + args,
+                                       stderr=subprocess.STDOUT,
+                                       timeout=600).decode()
+    except subprocess.CalledProcessError as exc:
+        log.debug("Failed to %s git repo: %s", action, exc.output)
+    except (OSError, subprocess.SubprocessError) as exc:
+        log.debug("Failed to %s git repo: %r", action, exc)
+    raise Exception("Failed to %s git repo" % action)
+
+
+def strip_credentials(url):
+    """Remove any username and password from a URL"""
+    parts = urllib.parse.urlsplit(url)
+    if '@' not in parts.netloc:
+        return url
+    return urllib.parse.urlunsplit(
+        parts._replace(netloc=parts.netloc.rsplit('@', 1)[1]))
+
+
+def get_git_mirror(repo, refresh=True):
+    """Return the path of the local bare mirror of a Git repository
+
+    The mirror is created on first use. Later on, it is updated with an
+    incremental fetch, if `refresh` is True and it was last updated more
+    than GIT_MIRROR_MAX_AGE seconds ago.
+
+    The credentials of `repo` are never stored in the mirror's config, which
+    is readable by anyone who may clone the mirror. Fetches pass the URL
+    explicitly instead.
+
+    """
+    if not os.path.isdir(GIT_MIRRORS_DIR):
+        os.makedirs(GIT_MIRRORS_DIR, exist_ok=True)
+    path = os.path.join(GIT_MIRRORS_DIR,
+                        hashlib.sha256(repo.encode()).hexdigest())
+    outdated = time.time() - GIT_MIRROR_MAX_AGE
+    with file_lock(path + '.lock'):
+        if not os.path.isdir(path):
+            log.debug("Creating git mirror '%s'.", path)
+            tmpdir = tempfile.mkdtemp(dir=GIT_MIRRORS_DIR)
+            try:
+                _git('clone', 'clone', '--quiet', '--mirror', repo, tmpdir)
+                _git('clone', '--git-dir', tmpdir, 'remote', 'set-url',
+                     'origin', strip_credentials(repo))
+                _git('clone', '--git-dir', tmpdir,
+                     'config', 'fetch.unpackLimit', '1')
+                os.rename(tmpdir, path)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        elif refresh and os.path.getmtime(path) < outdated:
+            log.debug("Updating git mirror '%s'.", path)
+            # Mirrors created before credentials were stripped may still
+            # have them in their config.
+            _git('fetch', '--git-dir', path, 'remote', 'set-url',
+                 'origin', strip_credentials(repo))
+            _git('fetch', '--git-dir', path, 'fetch', '--quiet', '--prune',
+                 repo, '+refs/*:refs/*')
+            _git('fetch', '--git-dir', path, 'gc', '--auto', '--quiet')
+        else:
+            return path
+        # Allow the mirror to be served over Git's dumb HTTP protocol.
+        _git('update', '--git-dir', path, 'update-server-info')
+        os.utime(path)
+    return path
+
+
+def get_git_mirror_revision(path, branch):
+    """Return the commit SHA a branch or tag of a git mirror points to"""
+    try:
+        return _git('find branch', '--git-dir', path, 'rev-parse',
+                    '--verify', '--quiet', '%s^{commit}' % branch).strip()
+    except Exception:
+        raise Exception("Branch '%s' not found in git repo" % branch)
+
+
+@contextlib.contextmanager
+def checkout_git_mirror(path, revision):
+    """Check out a revision of a git mirror in a temporary directory"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        proc = subprocess.Popen(['git', '--git-dir', path, 'archive',
+                                 revision], stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tfile:
+            tfile.extractall(tmpdir)
+        if proc.wait():
+            raise Exception("Failed to check out git repo")
+        yield tmpdir
+
+
 def unpack(path, dirname='.'):
     """Unpack a tar or zip archive"""
     if tarfile.is_tarfile(path):
@@ -85,3 +380,361 @@ def find_path(dirname='.', filename=''):
         break
     log.info("Found entrypoint '%s'.", path)
     return path
+
+
+BLUEPRINT_EXTENSIONS = ('.yaml', '.yml')
+# Magic numbers of the gzip, bzip2 and xz streams tar archives may be
+# compressed with.
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00')
+
+
+def _member_name(name):
+    """Return the normalized name of an archive member or None if unsafe"""
+    name = posixpath.normpath(name.replace('\\', '/'))
+    if name.startswith('/') or name == '.' or name.split('/')[0] == '..':
+        return None
+    return name
+
+
+def find_member(names, filename=''):
+    """Find the name of the entrypoint among the file names of an archive
+
+    The entrypoint is searched for the same way `find_path` searches for it
+    in an extracted archive.
+
+    """
+    names = set(names)
+    prefix = ''
+    while True:
+        log.debug("Searching for entrypoint '%s' in archive directory '%s'.",
+                  filename or 'main.*', prefix or '/')
+        children = set(name[len(prefix):].split('/', 1)[0]
+                       for name in names if name.startswith(prefix))
+        if not children:
+            raise Exception("Archive directory '%s' is empty." % prefix)
+        if len(children) == 1:
+            path = prefix + children.pop()
+            if path in names:
+                break
+            prefix = path + '/'
+            continue
+        if filename and prefix + filename in names:
+            path = prefix + filename
+            break
+        paths = sorted(prefix + child for child in children
+                       if fnmatch.fnmatch(child, 'main.*'))
+        if not paths:
+            raise Exception("No files match 'main.*' in '%s'." % prefix)
+        if len(paths) > 1:
+            log.warning("Multiple files match 'main.*' in '%s'.", prefix)
+        path = paths[0]
+        break
+    log.info("Found entrypoint '%s'.", path)
+    return path
+
+
+def _extract_member(fobj, name, dirname):
+    path = os.path.join(dirname, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as dest:
+        shutil.copyfileobj(fobj, dest)
+
+
+class _Prepended(object):
+    """A file object, which reads `head` before the rest of `fileobj`"""
+
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.fileobj.read(), b''
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+
+def _read_head(fileobj, size):
+    """Read `size` bytes off `fileobj`, or fewer, if it ends earlier"""
+    head = b''
+    while len(head) < size:
+        data = fileobj.read(size - len(head))
+        if not data:
+            break
+        head += data
+    return head
+
+
+def unpack_blueprint(fileobj, dirname, filename='', plain=''):
+    """Extract the blueprint files of a tar or zip archive
+
+    `fileobj` may be the path of the archive or a readable file object, such
+    as an HTTP response, which is then read as a stream. Only YAML files and
+    the entrypoint are extracted to `dirname`, so any plugins or artifacts
+    bundled in the archive are skipped. Return the path of the extracted
+    entrypoint.
+
+    Archives are detected by their header. If `fileobj` is not a tar or zip
+    archive, it is saved to `plain` and its path is returned, if specified,
+    or an exception is raised otherwise.
+
+    """
+    if isinstance(fileobj, str):
+        with open(fileobj, 'rb') as fobj:
+            return unpack_blueprint(fobj, dirname, filename, plain)
+
+    filename = _member_name(filename or '') or ''
+
+    def wanted(name):
+        if name.endswith(BLUEPRINT_EXTENSIONS) or name == filename:
+            return True
+        if filename and name.endswith('/' + filename):
+            return True
+        return fnmatch.fnmatch(posixpath.basename(name), 'main.*')
+
+    magic = _read_head(fileobj, 512)
+    fileobj = _Prepended(magic, fileobj)
+    if magic[:2] == b'PK':
+        # The central directory of zip archives is at their end.
+        spooled = tempfile.TemporaryFile()
+        shutil.copyfileobj(fileobj, spooled)
+        spooled.seek(0)
+        log.debug("Extracting blueprint from zip archive in '%s'.", dirname)
+        with spooled, zipfile.ZipFile(spooled) as zfile:
+            members = {}
+            for info in zfile.infolist():
+                name = _member_name(info.filename)
+                if name and not info.is_dir():
+                    members[name] = info
+            entrypoint = find_member(members, filename)
+            for name, info in members.items():
+                if name == entrypoint or \
+                        name.endswith(BLUEPRINT_EXTENSIONS):
+                    with zfile.open(info) as fobj:
+                        _extract_member(fobj, name, dirname)
+    elif magic.startswith(COMPRESSED_MAGIC) or magic[257:262] == b'ustar':
+        log.debug("Extracting blueprint from tar stream in '%s'.", dirname)
+        names = []
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tfile:
+            for tarinfo in tfile:
+                name = _member_name(tarinfo.name)
+                if not name or not tarinfo.isfile():
+                    continue
+                names.append(name)
+                if wanted(name):
+                    _extract_member(tfile.extractfile(tarinfo), name,
+                                    dirname)
+        entrypoint = find_member(names, filename)
+    elif plain:
+        log.debug("Saving plain blueprint to '%s'.", plain)
+        with open(plain, 'wb') as fobj:
+            shutil.copyfileobj(fileobj, fobj)
+        return plain
+    else:
+        raise Exception("File is not a valid tar or zip archive.")
+    return os.path.join(dirname, *entrypoint.split('/'))
+
+
+class CachedImportResolver(DefaultImportResolver):
+    """Resolve the imports of blueprints through the downloads cache
+
+    Imported files are revalidated at most every `max_age` seconds and the
+    cached copy is used, if their host is unreachable. The URLs of imports
+    are rewritten according to `rules`, a list of {prefix: replacement}
+    dicts, before falling back to the original URL.
+
+    """
+
+    def __init__(self, rules=None, max_age=0):
+        super(CachedImportResolver, self).__init__(rules)
+        self.max_age = max_age
+
+    def resolve(self, import_url):
+        if not DOWNLOADS_DIR:
+            return super(CachedImportResolver, self).resolve(import_url)
+        urls = []
+        for rule in self.rules:
+            for prefix, replacement in rule.items():
+                if import_url.startswith(prefix):
+                    urls.append(replacement + import_url[len(prefix):])
+        urls.append(import_url)
+        for url in urls:
+            try:
+                path = download(url, max_age=self.max_age,
+                                stale_on_error=True)
+            except Exception as exc:
+                log.warning("Failed to resolve import %s: %r", url, exc)
+                continue
+            with open(path) as fobj:
+                return fobj.read()
+        raise DSLParsingLogicException(
+            13, "Import failed: Unable to open import url %s" % import_url)
+
+
+if yaml.__with_libyaml__:
+    from yaml.cyaml import CParser
+
+    class _SectionLoader(CParser, Composer, SafeConstructor, Resolver):
+        """YAML loader that composes nodes out of LibYAML's events"""
+
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+else:
+    _SectionLoader = yaml.SafeLoader
+
+
+def read_yaml_sections(stream, sections):
+    """Load only the given top-level sections of a YAML document
+
+    The document is read as a stream of events and only the nodes of the
+    requested sections are composed and constructed, so that the rest of it
+    costs little more than tokenizing it. Return a dict of the sections
+    found.
+
+    """
+    loader = _SectionLoader(stream)
+    try:
+        loader.get_event()  # StreamStartEvent
+        if loader.check_event(yaml.StreamEndEvent):
+            return {}
+        loader.get_event()  # DocumentStartEvent
+        if not loader.check_event(yaml.MappingStartEvent):
+            raise Exception("Blueprint is not a YAML mapping.")
+        loader.get_event()
+        result = {}
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = loader.compose_node(None, None)
+            if isinstance(key, yaml.ScalarNode) and key.value in sections:
+                node = loader.compose_node(None, None)
+                result[key.value] = loader.construct_document(node)
+                continue
+            depth = 0
+            while True:
+                event = loader.get_event()
+                if isinstance(event, (yaml.MappingStartEvent,
+                                      yaml.SequenceStartEvent)):
+                    depth += 1
+                elif isinstance(event, (yaml.MappingEndEvent,
+                                        yaml.SequenceEndEvent)):
+                    depth -= 1
+                if not depth:
+                    break
+        return result
+    finally:
+        loader.dispose()
+
+
+def read_blueprint(path=None, content=None, resolver=None):
+    """Read the inputs and workflows of a blueprint and its imports
+
+    The blueprint is read from `path` or from its `content`. Imports over
+    HTTP are fetched by `resolver` and relative ones are looked up next to
+    the importing file. Sections of imports are overridden by those of the
+    importing files. Unlike the DSL parser, no plan is built and nothing is
+    validated. An exception is raised for any construct that is not
+    supported, such as namespaced imports, in which case the DSL parser
+    should be used instead.
+
+    """
+    result = {'inputs': {}, 'workflows': {}}
+    seen = set()
+
+    def merge(location, content=None):
+        if location in seen:
+            return
+        seen.add(location)
+        if content is None:
+            if urllib.parse.urlparse(location).scheme in ('http', 'https',
+                                                          'ftp'):
+                if resolver is None:
+                    raise Exception("No resolver for import '%s'." % location)
+                content = resolver.fetch_import(location)
+            else:
+                with open(location) as fobj:
+                    content = fobj.read()
+        sections = read_yaml_sections(content, ('imports', 'inputs',
+                                                'workflows'))
+        for url in sections.get('imports') or []:
+            if not isinstance(url, str) or '--' in url or \
+                    url.startswith('plugin:'):
+                raise Exception("Unsupported import '%s'." % url)
+            if url.startswith('file:'):
+                url = urllib.request.url2pathname(url[len('file:'):])
+            elif not urllib.parse.urlparse(url).scheme:
+                if location is None:
+                    raise Exception("Relative import '%s'." % url)
+                if urllib.parse.urlparse(location).scheme:
+                    url = urllib.parse.urljoin(location, url)
+                else:
+                    url = os.path.join(os.path.dirname(location), url)
+            merge(url)
+        result['inputs'].update(sections.get('inputs') or {})
+        for name, workflow in (sections.get('workflows') or {}).items():
+            if isinstance(workflow, str):
+                workflow = {'mapping': workflow}
+            result['workflows'][name] = {
+                'parameters': workflow.get('parameters') or {}}
+
+    merge(os.path.abspath(path) if path else None, content)
+    return result
+
+
+def docker_create(name, image_id, entrypoint, command=None, env=None):
+    """Create and start a container, overriding the image's entrypoint
+
+    Return the id of the container.
+
+    """
+    conn = docker_connect()
+    payload = {'Image': image_id, 'Entrypoint': entrypoint,
+               'Cmd': command or [], 'Env': env or [], 'Tty': True}
+    result = conn.connection.request(
+        '/v%s/containers/create' % conn.version, params={'name': name},
+        data=json.dumps(payload), method='POST')
+    container_id = result.object['Id']
+    conn.connection.request(
+        '/v%s/containers/%s/start' % (conn.version, container_id),
+        method='POST')
+    log.debug("Started container '%s' (%s).", name, container_id)
+    return container_id
+
+
+def docker_exec(container_id, command, env=None):
+    """Run a command in a running container, without waiting for it"""
+    conn = docker_connect()
+    payload = {'Cmd': command, 'Env': env or [], 'Tty': True,
+               'AttachStdout': False, 'AttachStderr': False}
+    result = conn.connection.request(
+        '/v%s/containers/%s/exec' % (conn.version, container_id),
+        data=json.dumps(payload), method='POST')
+    conn.connection.request(
+        '/v%s/exec/%s/start' % (conn.version, result.object['Id']),
+        data=json.dumps({'Detach': True, 'Tty': True}), method='POST')
+
+
+def docker_state(container_id):
+    """Return the state of a container, or None, if it does not exist"""
+    conn = docker_connect()
+    try:
+        result = conn.connection.request(
+            '/v%s/containers/%s/json' % (conn.version, container_id))
+    except Exception as exc:
+        if 404 in (getattr(exc, 'http_code', None),
+                   getattr(exc, 'code', None)):
+            return None
+        raise
+    return result.object['State']
+
+
+def docker_remove(container_id):
+    """Forcibly remove a container"""
+    conn = docker_connect()
+    conn.connection.request(
+        '/v%s/containers/%s' % (conn.version, container_id),
+        params={'force': 1}, method='DELETE')
@@ -1,14 +1,24 @@
 import os
+import json
+import time
 import uuid
+import hashlib
 import tempfile
 import logging
+import contextvars
+import urllib.request
+
+from datetime import datetime, timedelta, timezone
+from collections import Counter
 
 import requests
 
-from functools import cmp_to_key
+from functools import cmp_to_key, partial, wraps
 
 import mongoengine as me
 
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+
 import dsl_parser.parser as parser
 
 from mist.api import helpers as io_helpers
@@ -19,14 +29,50 @@ from mist.api.mongoengine_extras import sanitize_dict
 
 from mist.api.auth.models import ApiToken
 
-from mist.api.tag.methods import add_tags_to_resource, get_tags_for_resource
+from mist.api.tag.models import Tag
+from mist.api.tag.methods import add_tags_to_resource
+
+from mist.api.users.models import Owner, User
 
 from mist.orchestration.config import CLOUDIFY_MIST_PLUGIN_IMAGE
-from mist.orchestration.helpers import download, unpack, find_path
-from mist.orchestration.models import Template, Stack
+from mist.orchestration.config import CLOUDIFY_MIST_PLUGIN_ENTRYPOINT
+from mist.orchestration.config import WORKFLOW_CONTAINER_POOL_SIZE
+from mist.orchestration.config import WORKFLOW_CONTAINER_IDLE_COMMAND
+from mist.orchestration.config import TEMPLATE_ANALYSIS_CACHE_SIZE
+from mist.orchestration.config import LIST_BATCH_SIZE
+from mist.orchestration.config import MAX_RUNNING_WORKFLOWS
+from mist.orchestration.config import MAX_RUNNING_WORKFLOWS_PER_OWNER
+from mist.orchestration.config import WORKFLOW_RUN_TIMEOUT
+from mist.orchestration.config import STACK_WORKFLOWS_SUMMARY_SIZE
+from mist.orchestration.config import WORKFLOW_OUTPUT_CHUNK_SIZE
+from mist.orchestration.config import SESSION_UPDATE_DEBOUNCE
+from mist.orchestration.config import WORKFLOW_TOKEN_TTL
+from mist.orchestration.config import WORKFLOW_TOKEN_REUSE_PERIOD
+from mist.orchestration.config import ARCHIVE_RETENTION_DAYS
+from mist.orchestration.config import ARCHIVE_BATCH_SIZE
+from mist.orchestration.config import GIT_MIRRORS_DIR, GIT_MIRROR_SERVE
+from mist.orchestration.config import DOWNLOADS_DIR
+from mist.orchestration.config import IMPORTS_MAX_AGE, IMPORT_RESOLVER_RULES
+from mist.orchestration.helpers import download, find_path
+from mist.orchestration.helpers import unpack_blueprint
+from mist.orchestration.helpers import CachedImportResolver, read_blueprint
+from mist.orchestration.helpers import get_file_digest, get_git_revision
+from mist.orchestration.helpers import docker_create, docker_exec
+from mist.orchestration.helpers import docker_remove, docker_state
+from mist.orchestration.helpers import get_git_mirror, get_git_mirror_revision
+from mist.orchestration.helpers import checkout_git_mirror
+from mist.orchestration.models import Template, Stack, TemplateAnalysis
+from mist.orchestration.models import WorkflowRun, PooledContainer
+from mist.orchestration.models import WorkflowOutputChunk
+from mist.orchestration.models import CollectionVersion
+from mist.orchestration.models import _reference_id
+from mist.orchestration.models import PendingSessionUpdate
+from mist.orchestration.models import WorkflowToken
+from mist.orchestration.exceptions import TemplateParseError
 
 from mist.api.exceptions import BadRequestError
 from mist.api.exceptions import ConflictError
+from mist.api.exceptions import NotFoundError
 from mist.api.exceptions import RequiredParameterMissingError
 
 from mist.api.logs.methods import log_event
@@ -38,140 +84,945 @@ if config.HAS_RBAC:
 
 log = logging.getLogger(__name__)
 
-# SEC
-def filter_list_templates(auth_context):
-    query = {'owner': auth_context.owner, 'deleted': None}
+# Bump this whenever the output of `get_workflows` or `form_inputs` changes in
+# order to invalidate all cached template analyses.
+TEMPLATE_ANALYSIS_VERSION = 1
+
+# Template analysis cache counters of the current process.
+TEMPLATE_ANALYSIS_STATS = {'hits': 0, 'misses': 0}
+
+# The fields stacks and templates may be sorted by, when paginating.
+LIST_SORT_FIELDS = ('created', 'name')
+
+# Maximum number of jobs that may be looked up with a single request.
+MAX_JOB_IDS = 1000
+
+# Maximum number of stacks that may be created or run with a single request.
+MAX_BULK_SIZE = 500
+
+# The session updates collected by `coalesce_session_updates`, per owner id.
+_session_updates = contextvars.ContextVar('session_updates', default=None)
+
+def get_tags_for_resources(owner, resource_type, resource_ids):
+    """Return the tags of many resources of the same type at once.
+
+    The tags of all resources are fetched with a single query and returned
+    as a dict of tag dicts, keyed by resource id.
+
+    """
+    tags = {resource_id: {} for resource_id in resource_ids}
+    if not tags:
+        return tags
+    for tag in Tag.objects(owner=owner, resource_type=resource_type,
+                           resource_id__in=list(tags)).only(
+                               'resource_id', 'key', 'value'):
+        tags[tag.resource_id][tag.key] = tag.value
+    return tags
+
+
+def add_tags_to_resources(owner, resource_type, resource_ids, tags):
+    """Tag many new resources of the same type at once.
+
+    All tags are inserted with a single write. Unlike mist.api's
+    `add_tags_to_resource`, no session update is triggered, so that callers
+    trigger a single one, once done. Since the resources are new, they are
+    expected to have no tags yet.
+
+    """
+    tags = dict(tags or {})
+    if not tags or not resource_ids:
+        return
+    Tag.objects.insert([Tag(owner=owner, resource_type=resource_type,
+                            resource_id=resource_id, key=key, value=value)
+                        for resource_id in resource_ids
+                        for key, value in tags.items()], load_bulk=False)
+
+
+def parse_fields(fields):
+    """Parse the `fields` request parameter into a set of field names.
+
+    `fields` may either be a comma-separated string or a list. None is
+    returned, if no specific fields have been requested.
+
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    return {field.strip() for field in fields if field.strip()} or None
+
+
+def project(queryset, fields):
+    """Restrict `queryset` to the database fields requested in `fields`"""
+    if not fields:
+        return queryset
+    return queryset.only(*[field for field in fields
+                           if field in queryset._document._fields])
+
+
+def parse_list_params(params):
+    """Parse the pagination parameters of the list endpoints.
+
+    Return a dict with the `sort`, `limit` and `after` keyword arguments of
+    `iter_list_stacks` and `iter_list_templates`.
+
+    """
+    kwargs = {'sort': params.get('sort') or None,
+              'after': params.get('after') or None,
+              'limit': None}
+    if params.get('limit'):
+        try:
+            kwargs['limit'] = int(params['limit'])
+        except (TypeError, ValueError):
+            kwargs['limit'] = 0
+        if kwargs['limit'] <= 0:
+            raise BadRequestError('The limit must be a positive integer')
+    if kwargs['sort'] and kwargs['sort'].lstrip('-') not in LIST_SORT_FIELDS:
+        raise BadRequestError('Results may only be sorted by %s' %
+                              ', '.join(LIST_SORT_FIELDS))
+    if (kwargs['limit'] or kwargs['after']) and not kwargs['sort']:
+        kwargs['sort'] = 'created'
+    return kwargs
+
+
+def _parse_datetime(value, name):
+    try:
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise BadRequestError('%s must be an ISO 8601 date or datetime' %
+                              name)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def parse_filter_params(params, resource_type):
+    """Parse the filtering parameters of the list endpoints.
+
+    Return a dict of the filters understood by `iter_list_stacks` and
+    `iter_list_templates`. Tags are given as a comma-separated list of
+    `key` or `key=value` items, all of which must match.
+
+    """
+    filters = {}
+    for key in ('status', 'name_prefix', 'search'):
+        if params.get(key):
+            filters[key] = params[key]
+    if resource_type == 'stack' and params.get('template'):
+        filters['template'] = params['template']
+    if params.get('tag'):
+        tags = params['tag']
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        filters['tags'] = {}
+        for tag in tags:
+            key, _, value = tag.partition('=')
+            if not key.strip():
+                raise BadRequestError('Invalid tag: %s' % tag)
+            filters['tags'][key.strip()] = value.strip() or None
+    for key in ('created_after', 'created_before'):
+        if params.get(key):
+            filters[key] = _parse_datetime(params[key], key)
+    return filters
+
+
+def _filter(auth_context, queryset, resource_type, filters, allowed=None):
+    """Apply the `parse_filter_params` filters to `queryset`.
+
+    Tags are looked up in the Tag collection first and the matching ids are
+    intersected with `allowed`, if given, so that every other filter is
+    evaluated by the database along with the owner's list index.
+
+    """
+    if filters.get('tags'):
+        for key, value in filters['tags'].items():
+            query = {'owner': auth_context.owner,
+                     'resource_type': resource_type, 'key': key}
+            if value is not None:
+                query['value'] = value
+            ids = set(Tag.objects(**query).distinct('resource_id'))
+            allowed = ids if allowed is None else ids & set(allowed)
+    if allowed is not None:
+        queryset = queryset.filter(id__in=list(allowed))
+    if filters.get('status'):
+        queryset = queryset.filter(status=filters['status'])
+    if filters.get('template'):
+        queryset = queryset.filter(template=filters['template'])
+    if filters.get('name_prefix'):
+        queryset = queryset.filter(name__startswith=filters['name_prefix'])
+    if filters.get('created_after'):
+        queryset = queryset.filter(created__gte=filters['created_after'])
+    if filters.get('created_before'):
+        queryset = queryset.filter(created__lt=filters['created_before'])
+    if filters.get('search'):
+        queryset = queryset.search_text(filters['search'])
+    return queryset
+
+
+def _iter_list(auth_context, document, resource_type, fields=None,
+               sort=None, limit=None, after=None, filters=None):
+    """Return an iterator over the dicts of the `document` resources.
+
+    Only the resources visible to `auth_context` and matching `filters`, as
+    returned by `parse_filter_params`, are returned.
+
+    If `sort` is specified, results are ordered by the given field and then
+    by id, so that `after`, the id of the last resource of the previous page,
+    can be used as a cursor to resume from.
+
+    Resources are serialized and tagged in batches, as they are read from
+    the database cursor, so that they can be streamed back to the client.
+
+    """
+    allowed = None
     if not auth_context.is_owner():
-        query['id__in'] = auth_context.get_allowed_resources(rtype='templates')
+        allowed = auth_context.get_allowed_resources(
+            rtype='%ss' % resource_type)
+    queryset = _filter(auth_context,
+                       document.objects(owner=auth_context.owner,
+                                        deleted=None),
+                       resource_type, filters or {}, allowed)
+
+    if sort:
+        field = sort.lstrip('-')
+        descending = sort.startswith('-')
+        if after:
+            try:
+                last = document.objects.only(field).get(
+                    owner=auth_context.owner, id=after)
+            except document.DoesNotExist:
+                raise BadRequestError('Invalid cursor: %s' % after)
+            op = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                me.Q(**{'%s__%s' % (field, op): last[field]}) |
+                me.Q(**{field: last[field], 'id__%s' % op: last.id}))
+        queryset = queryset.order_by(sort, '-id' if descending else 'id')
+    if limit:
+        queryset = queryset.limit(limit)
+    queryset = project(queryset, fields).batch_size(LIST_BATCH_SIZE)
+    return _iter_dicts(auth_context, resource_type, queryset, fields)
+
+
+def _iter_dicts(auth_context, resource_type, queryset, fields=None):
+    batch = []
+    for resource in queryset:
+        batch.append(resource.as_dict(fields))
+        if len(batch) == LIST_BATCH_SIZE:
+            yield from _tag_batch(auth_context, resource_type, batch, fields)
+            batch = []
+    yield from _tag_batch(auth_context, resource_type, batch, fields)
+
+
+def _tag_batch(auth_context, resource_type, batch, fields=None):
+    if batch and (not fields or 'tags' in fields):
+        tags = get_tags_for_resources(auth_context.owner, resource_type,
+                                      [rdict['id'] for rdict in batch])
+        for rdict in batch:
+            rdict['tags'] = tags[rdict['id']]
+    return batch
+
+
+# SEC
+def iter_list_templates(auth_context, fields=None, sort=None, limit=None,
+                        after=None, filters=None):
+    return _iter_list(auth_context, Template, 'template', fields=fields,
+                      sort=sort, limit=limit, after=after, filters=filters)
+
+
+# SEC
+def filter_list_templates(auth_context, fields=None, sort=None, limit=None,
+                          after=None, filters=None):
+    return list(iter_list_templates(auth_context, fields=fields, sort=sort,
+                                    limit=limit, after=after,
+                                    filters=filters))
+
+
+# SEC
+def iter_list_stacks(auth_context, fields=None, sort=None, limit=None,
+                     after=None, filters=None):
+    return _iter_list(auth_context, Stack, 'stack', fields=fields,
+                      sort=sort, limit=limit, after=after, filters=filters)
+
 
-    templates = []
-    for template in Template.objects(**query):
-        tdict = template.as_dict()
-        tdict['tags'] = get_tags_for_resource(auth_context.owner, template)
-        templates.append(tdict)
-    return templates
+# SEC
+def filter_list_stacks(auth_context, fields=None, sort=None, limit=None,
+                       after=None, filters=None):
+    return list(iter_list_stacks(auth_context, fields=fields, sort=sort,
+                                 limit=limit, after=after, filters=filters))
+
+
+def list_workflow_runs(stack, limit=None, after=None):
+    """Return the workflow runs of `stack`, most recent first.
+
+    `after`, the job id of the last run of the previous page, can be used as
+    a cursor to resume from.
+
+    """
+    queryset = WorkflowRun.objects(stack=stack)
+    if after:
+        try:
+            last = WorkflowRun.objects.only('created').get(stack=stack,
+                                                           job_id=after)
+        except WorkflowRun.DoesNotExist:
+            raise BadRequestError('Invalid cursor: %s' % after)
+        queryset = queryset.filter(
+            me.Q(created__lt=last.created) |
+            me.Q(created=last.created, job_id__lt=last.job_id))
+    queryset = queryset.order_by('-created', '-job_id')
+    if limit:
+        queryset = queryset.limit(limit)
+    return [run.as_dict() for run in queryset]
+
+
+def bump_collection_versions(owner, collections):
+    """Increment the versions of `owner`'s `collections`"""
+    owner_id = getattr(owner, 'id', owner)
+    for collection in collections:
+        if collection in ('stacks', 'templates'):
+            CollectionVersion.objects(
+                id='%s:%s' % (owner_id, collection)).update_one(
+                    inc__version=1, upsert=True)
+
+
+def coalesce_session_updates(func):
+    """Merge the session updates triggered by `func` into one per owner.
+
+    The merged updates are triggered once `func` returns.
+
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _session_updates.get() is not None:
+            return func(*args, **kwargs)
+        pending = {}
+        token = _session_updates.set(pending)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _session_updates.reset(token)
+            for owner_id, sections in pending.items():
+                schedule_session_update(owner_id, sections)
+    return wrapper
+
+
+def trigger_session_update(owner, sections):
+    """Bump the versions of the changed collections and notify the clients.
+
+    Notifications are merged with any others triggered for the same owner
+    within the current `coalesce_session_updates` scope or within the last
+    SESSION_UPDATE_DEBOUNCE seconds.
+
+    """
+    owner_id = getattr(owner, 'id', owner)
+    bump_collection_versions(owner_id, sections)
+    pending = _session_updates.get()
+    if pending is not None:
+        pending.setdefault(owner_id, set()).update(sections)
+    else:
+        schedule_session_update(owner_id, sections)
+
+
+def schedule_session_update(owner_id, sections):
+    """Update the given sections of the owner's session, once the debounce
+    window of the first pending update is over"""
+    if not SESSION_UPDATE_DEBOUNCE:
+        io_helpers.trigger_session_update(owner_id, list(sections))
+        return
+    now = datetime.utcnow()
+    previous = PendingSessionUpdate._get_collection().find_one_and_update(
+        {'_id': owner_id},
+        {'$addToSet': {'sections': {'$each': list(sections)}},
+         '$setOnInsert': {'created': now}},
+        upsert=True, return_document=ReturnDocument.BEFORE)
+    # The update is sent by a delayed task, which is scheduled along with
+    # the first pending update. It is rescheduled, in case it got lost.
+    if previous is None or \
+            previous['created'] < now - timedelta(minutes=1):
+        from mist.orchestration import tasks
+        tasks.send_session_update.send_with_options(
+            args=(owner_id, ), delay=int(SESSION_UPDATE_DEBOUNCE * 1000))
+
+
+def send_session_update(owner_id):
+    """Send the pending session update of an owner, if any"""
+    pending = PendingSessionUpdate.objects(id=owner_id).modify(remove=True)
+    if pending is not None and pending.sections:
+        io_helpers.trigger_session_update(owner_id, pending.sections)
+
+
+def _hash(*parts):
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def get_etag(document, owner, resource_id, fields=None):
+    """Return the ETag of a Stack or Template.
+
+    Only the version of the resource and its tags are read from the
+    database. Return None, if the resource does not exist.
+
+    """
+    resource = document.objects(owner=owner, id=resource_id,
+                                deleted=None).only('version').first()
+    if resource is None:
+        return None
+    tags = Tag.objects(owner=owner, resource_type=document.__name__.lower(),
+                       resource_id=resource_id).order_by('key').scalar(
+                           'key', 'value')
+    return _hash(resource_id, resource.version, list(tags),
+                 sorted(fields or []))
 
 
 # SEC
-def filter_list_stacks(auth_context):
-    query = {'owner': auth_context.owner, 'deleted': None}
+def get_list_etag(auth_context, resource_type, params):
+    """Return the ETag of a list of stacks or templates.
+
+    It changes whenever any of the owner's resources, the tags thereof or
+    the resources visible to `auth_context` change, as well as with the
+    parameters of the request. Tags are hashed along with the version of
+    the collection, since they may be changed through mist.api, which does
+    not bump it.
+
+    """
+    collection = '%ss' % resource_type
+    version = CollectionVersion.objects(
+        id='%s:%s' % (auth_context.owner.id, collection)).scalar(
+            'version').first()
+    allowed = None
     if not auth_context.is_owner():
-        query['id__in'] = auth_context.get_allowed_resources(rtype='stacks')
+        allowed = sorted(auth_context.get_allowed_resources(rtype=collection))
+    tags = Tag.objects(owner=auth_context.owner,
+                       resource_type=resource_type).order_by(
+                           'resource_id', 'key').scalar(
+                               'resource_id', 'key', 'value')
+    return _hash(collection, version, _hash(list(tags)), allowed,
+                 sorted(params.items()))
 
-    stacks = []
-    for stack in Stack.objects(**query):
-        sdict = stack.as_dict()
-        sdict['tags'] = get_tags_for_resource(auth_context.owner, stack)
-        stacks.append(sdict)
-    return stacks
+
+# SEC
+def get_workflow_runs(auth_context, job_ids):
+    """Return the workflow runs of the given jobs, which are visible to
+    `auth_context`, keyed by job id.
+
+    All runs are fetched with a single query on their primary key.
+
+    """
+    if len(job_ids) > MAX_JOB_IDS:
+        raise BadRequestError('At most %d job ids may be requested at once' %
+                              MAX_JOB_IDS)
+    query = {'owner': auth_context.owner, 'job_id__in': job_ids}
+    if not auth_context.is_owner():
+        query['stack__in'] = auth_context.get_allowed_resources(
+            rtype='stacks')
+    return {run.job_id: run.as_dict()
+            for run in WorkflowRun.objects(**query)}
 
 
 def run_workflow(auth_context, stack, workflow, inputs=None):
+    """Queue the execution of `workflow` on `stack`.
+
+    The workflow's container is started by `dispatch_workflows`, as soon as
+    the concurrency limits allow. Return the id of the job.
 
-    if inputs:
-        stack.inputs.update({workflow: inputs})
+    """
+    job_id = run_workflows(auth_context, [stack], workflow, [inputs])[0]
+    if job_id is None:
+        raise ConflictError('Stack "%s" was modified concurrently, '
+                            'please retry' % stack.name)
+    return job_id
 
-    stack.job_id = job_id = uuid.uuid4().hex
 
-    if stack.deploy or workflow == 'uninstall':
+def run_workflows(auth_context, stacks, workflow, inputs=None):
+    """Queue the execution of `workflow` on each of `stacks`.
 
-        auth_context.check_perm('stack', 'run_workflow', stack.id)
+    `inputs` is a list with the inputs of the workflow for each Stack, if
+    specified. New Stacks are bulk-inserted. Existing ones are updated with
+    a single bulk write, each provided that it has not been modified since
+    it was loaded. All workflow runs are inserted at once and are started
+    by `dispatch_workflows`, which is notified once.
 
-        # Create API Token. Generate SuperToken, if appropriate.
-        token_cls = ApiToken
-        if not auth_context.is_owner() and stack.template.setuid:
-            if not config.HAS_RBAC:
-                raise NotImplementedError()
-            token_cls = SuperToken
-            log.warning('A SuperToken will be generated for User %s of %s '
-                        'in order to execute workflow "%s" on Stack %s',
-                        auth_context.user.email, auth_context.org, workflow,
-                        stack.id)
+    Return a list with the job id of each Stack, or None for any Stacks,
+    which were modified concurrently.
 
-        new_api_token = token_cls()
-        new_api_token.name = "stack_{0}_{1}".format(stack.name, uuid.uuid4().hex)
-        new_api_token.ttl = 3600
-        new_api_token.set_user(auth_context.user)
-        new_api_token.orgs = [auth_context.org]
-        new_api_token.save()
+    """
+    if inputs is None:
+        inputs = [None] * len(stacks)
 
-        inputs = inputs or stack.inputs.get(workflow)
-        if workflow == 'install':
-            stack.status = "start_creation"
+    # Run as the Owner, by means of a SuperToken, if appropriate.
+    setuid_templates = set()
+    if not auth_context.is_owner():
+        template_ids = {_reference_id(stack, 'template') for stack in stacks}
+        setuid_templates = set(Template.objects(
+            id__in=list(template_ids), setuid=True).scalar('id'))
+        if setuid_templates and not config.HAS_RBAC:
+            raise NotImplementedError()
+
+    job_ids, runs, created, updates = [], {}, [], []
+    for stack, stack_inputs in zip(stacks, inputs):
+        if stack_inputs:
+            stack.inputs.update({workflow: stack_inputs})
+
+        stack.job_id = job_id = uuid.uuid4().hex
+        job_ids.append(job_id)
+
+        if stack.deploy or workflow == 'uninstall':
+            auth_context.check_perm('stack', 'run_workflow', stack.id)
+            runs[stack.id] = WorkflowRun(
+                job_id=job_id, owner=stack.owner, stack=stack,
+                user=auth_context.user, workflow=workflow,
+                inputs=stack_inputs or stack.inputs.get(workflow),
+                setuid=_reference_id(stack, 'template') in setuid_templates)
+            stack.status = 'queued'
+
+        if stack._created:
+            created.append(stack)
+            continue
+
+        # Only set the fields that changed, provided that the Stack has not
+        # been modified since it was loaded.
+        update = {'job_id': job_id, 'status': stack.status,
+                  'deploy': stack.deploy}
+        if stack_inputs:
+            sanitized = Stack.inputs.to_mongo({workflow: stack_inputs})
+            for key, value in sanitized.items():
+                update['inputs.%s' % key] = value
+        if not stack.version:
+            version = {'$in': [0, None]}
         else:
-            stack.status = 'workflow_started'
+            version = stack.version
+        updates.append(UpdateOne({'_id': stack.id, 'version': version},
+                                 {'$set': update, '$inc': {'version': 1}}))
 
-        try:
-            wparams = [stack.id]
-            wparams.append("-v")
-            if workflow:
-                wparams.append("-w")
-                wparams.append(workflow)
-            wparams.append("-t")
-            wparams.append(new_api_token.token)
-            wparams.append("-u")
-            wparams.append(config.PORTAL_URI)
-        except Exception as exc:
-            log.error(str(exc))
-            return False
+    if created:
+        insert_stacks(created)
 
+    if updates:
+        result = Stack._get_collection().bulk_write(updates, ordered=False)
+        updated = set(job_ids)
+        if result.matched_count < len(updates):
+            # Find out which updates did not match, by their job ids.
+            updated = set(Stack.objects(
+                id__in=[stack.id for stack in stacks]).scalar('job_id'))
+        created_ids = {stack.id for stack in created}
+        for i, stack in enumerate(stacks):
+            if stack.id in created_ids:
+                continue
+            if job_ids[i] in updated:
+                stack.version = (stack.version or 0) + 1
+            else:
+                log.warning('%s was modified concurrently', stack)
+                runs.pop(stack.id, None)
+                job_ids[i] = None
+
+    if runs:
+        from mist.orchestration import tasks
+        WorkflowRun.objects.insert(list(runs.values()), load_bulk=False)
+        tasks.dispatch_workflows.send()
+
+    return job_ids
+
+
+def insert_stacks(stacks):
+    """Validate and bulk-insert new Stacks"""
+    names = Counter(stack.name for stack in stacks)
+    existing = set(Stack.objects(
+        owner=stacks[0].owner, name__in=list(names),
+        deleted=None).scalar('name'))
+    existing.update(name for name, count in names.items() if count > 1)
+    if existing:
+        raise ConflictError('Stack "%s" already exists' %
+                            '", "'.join(sorted(existing)))
+    for stack in stacks:
         try:
-            stack.save()
+            stack.validate()
         except me.ValidationError as err:
             log.error('Error saving %s: %s', stack, err.to_dict())
             raise BadRequestError({'msg': str(err),
-                                'errors': err.to_dict()})
-        except me.NotUniqueError as err:
-            log.error('%s is not unique: %s', stack, err)
-            raise ConflictError('Stack "%s" already exists' % stack.name)
-
-        log.info("docker run %s %s" % (job_id, " ".join(wparams)))
-
-        # Set the list of ENVs to pass to the container.
-        # 1. MIST_GIT_CLONE_COMMAND is the git-clone command that will be used
-        #    by the container to clone the Git repo. Since the Git URL may
-        #    include Basic Auth, we do not want to have it returned by the API.
-        # 2. TODO
-        env = ['MIST_GIT_CLONE_COMMAND=%s' % stack.template.git_clone_command]
-
-        container = docker_run(name='orchestration-workflow-%s' % job_id,
-                               image_id=CLOUDIFY_MIST_PLUGIN_IMAGE,
-                               env=env, command=' '.join(wparams))
-
-        stack.container_id = container.id
-        # TODO deprecate container_id, store it in model
-        log_entry = {
-            'job_id': job_id,
-            'stack_id': stack.id,
-            'container_id': container.id,
-            'user_email': auth_context.user.email,
-            'owner_id': auth_context.owner.id,
-            'template_id': stack.template.id,
-            'workflow': workflow,
-            'inputs': inputs,
-            'setuid': config.HAS_RBAC and token_cls is SuperToken,
-        }
-        event = log_event(event_type='job', action='workflow_started', **log_entry)
-        stack.workflows.append({'name': workflow,
-                                'job_id': job_id,
-                                'timestamp': event['time'],
-                                'error': False})
-
+                                   'errors': err.to_dict()})
+        stack.version = 1
     try:
-        stack.save()
-    except me.ValidationError as err:
-        log.error('Error saving %s: %s', stack, err.to_dict())
-        raise BadRequestError({'msg': str(err),
-                               'errors': err.to_dict()})
+        Stack.objects.insert(stacks, load_bulk=False)
     except me.NotUniqueError as err:
-        log.error('%s is not unique: %s', stack, err)
-        raise ConflictError('Stack "%s" already exists' % stack.name)
+        log.error('Stacks are not unique: %s', err)
+        raise ConflictError('Stack already exists')
+    for stack in stacks:
+        stack._created = False
+        stack._clear_changed_fields()
 
-    return job_id
+
+def dispatch_workflows():
+    """Start queued workflow runs, as long as the concurrency limits allow.
+
+    At most `MAX_RUNNING_WORKFLOWS` workflows may be running at any time and
+    at most `MAX_RUNNING_WORKFLOWS_PER_OWNER` per owner. Runs are started in
+    rounds. Every round starts the oldest queued run of each owner, who has
+    not reached the limit, beginning with the owners that have the fewest
+    running workflows. This way, a burst of workflows of a single owner may
+    not starve the rest.
+
+    Runs are claimed atomically, so dispatching from many processes at once
+    never starts a run twice. It may, however, briefly exceed the limits.
+
+    Return the number of runs started.
+
+    """
+    running = {group['_id']: group['count'] for group in
+               WorkflowRun.objects(status='running').aggregate([
+                   {'$group': {'_id': '$owner', 'count': {'$sum': 1}}}])}
+    slots = MAX_RUNNING_WORKFLOWS - sum(running.values())
+    started = 0
+    while slots > 0:
+        heads = [head for head in WorkflowRun.objects(
+            status='queued').aggregate([
+                {'$sort': {'created': 1}},
+                {'$group': {'_id': '$owner',
+                            'job_id': {'$first': '$_id'},
+                            'created': {'$first': '$created'}}},
+            ]) if running.get(head['_id'], 0) <
+            MAX_RUNNING_WORKFLOWS_PER_OWNER]
+        if not heads:
+            break
+        heads.sort(key=lambda head: (running.get(head['_id'], 0),
+                                     head['created']))
+        for head in heads[:slots]:
+            run = WorkflowRun.objects(job_id=head['job_id'],
+                                      status='queued').modify(
+                set__status='running', set__started_at=datetime.utcnow(),
+                new=True)
+            if run is None:  # Claimed by another process.
+                continue
+            running[head['_id']] = running.get(head['_id'], 0) + 1
+            slots -= 1
+            started += 1
+            try:
+                start_workflow(run)
+            except Exception:
+                log.exception('Failed to start workflow %s', run.job_id)
+                fail_workflow(run)
+    return started
+
+
+def reap_workflow_runs():
+    """Fail the running workflows, which will never report back.
+
+    These are the runs, whose container has exited or is gone, as well as
+    the ones running for longer than WORKFLOW_RUN_TIMEOUT seconds. The
+    latter include workflows that died in a pooled container, since pooled
+    containers keep running. Lost runs are finished as failed, so that their
+    Stack reflects the failure and they stop counting against the
+    concurrency limits.
+
+    Return the number of runs reaped.
+
+    """
+    now = datetime.utcnow()
+    timeout = now - timedelta(seconds=WORKFLOW_RUN_TIMEOUT)
+    reaped = 0
+    for run in WorkflowRun.objects(status='running').only(
+            'job_id', 'stack', 'workflow', 'container_id', 'started_at'):
+        if run.started_at and run.started_at < timeout:
+            reason = 'did not finish within %d seconds' % WORKFLOW_RUN_TIMEOUT
+        elif not run.container_id:  # Still starting.
+            continue
+        else:
+            try:
+                state = docker_state(run.container_id)
+            except Exception as exc:
+                log.warning('Failed to inspect container %s of workflow %s: '
+                            '%r', run.container_id, run.job_id, exc)
+                continue
+            if state and state.get('Status') not in ('exited', 'dead'):
+                continue
+            reason = 'lost its container %s' % run.container_id
+        log.warning('Workflow %s %s', run.job_id, reason)
+        stack = Stack.objects(id=_reference_id(run, 'stack')).first()
+        if stack is None:
+            run.update(set__status='error', set__finished_at=now)
+        else:
+            finish_workflow(stack, run.job_id, run.workflow, None,
+                            'Workflow %s' % reason, True)
+        reaped += 1
+    return reaped
+
+
+def fail_workflow(run):
+    """Mark a WorkflowRun, which could not be started, and its Stack as
+    failed"""
+    run.update(set__status='error', set__finished_at=datetime.utcnow())
+    Stack.objects(id=_reference_id(run, 'stack')).update_one(
+        set__status='error', inc__version=1)
+    trigger_session_update(_reference_id(run, 'owner'), ['stacks'])
+
+
+def create_workflow_token(run):
+    """Return the API token, which is passed to a workflow's container.
+
+    A token created for an earlier run of the same Stack, User and setuid
+    flag is reused, if it was created during the last
+    WORKFLOW_TOKEN_REUSE_PERIOD seconds and is still valid.
+
+    """
+    # Generate SuperToken, if appropriate.
+    token_cls = ApiToken
+    if run.setuid:
+        token_cls = SuperToken
+
+    key = '%s:%s:%d' % (_reference_id(run, 'stack'),
+                        _reference_id(run, 'user'), run.setuid)
+    now = datetime.utcnow()
+    scoped = WorkflowToken.objects(id=key, created__gt=now - timedelta(
+        seconds=WORKFLOW_TOKEN_REUSE_PERIOD)).first()
+    if scoped is not None:
+        token = token_cls.objects(id=scoped.token_id).first()
+        if token is not None and token.is_valid():
+            return token
+
+    if run.setuid:
+        log.warning('A SuperToken will be generated for User %s of %s '
+                    'in order to execute workflow "%s" on Stack %s',
+                    run.user.email, run.owner, run.workflow, run.stack.id)
+
+    new_api_token = token_cls()
+    new_api_token.name = "stack_{0}_{1}".format(run.stack.name,
+                                                uuid.uuid4().hex)
+    new_api_token.ttl = WORKFLOW_TOKEN_TTL
+    new_api_token.set_user(run.user)
+    new_api_token.orgs = [run.owner]
+    new_api_token.save()
+    WorkflowToken(id=key, token_id=str(new_api_token.id), created=now).save()
+    return new_api_token
+
+
+def reap_workflow_tokens():
+    """Delete the expired or revoked API tokens of workflows.
+
+    Return the number of tokens deleted.
+
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=WORKFLOW_TOKEN_TTL)
+    expired = (me.Q(created__lt=cutoff) &
+               (me.Q(last_accessed_at__lt=cutoff) |
+                me.Q(last_accessed_at=None)))
+    # SuperTokens are ApiTokens, as well.
+    deleted = ApiToken.objects(expired | me.Q(revoked=True),
+                               name__startswith='stack_').delete()
+    WorkflowToken.objects(created__lt=cutoff).delete()
+    return deleted
+
+
+def start_workflow(run):
+    """Start the container of a WorkflowRun, claimed by the dispatcher
+
+    Any errors are raised to the dispatcher, which marks the run as failed.
+
+    """
+    stack = run.stack
+    token = create_workflow_token(run)
+
+    wparams = [stack.id]
+    wparams.append("-v")
+    if run.workflow:
+        wparams.append("-w")
+        wparams.append(run.workflow)
+    wparams.append("-t")
+    wparams.append(token.token)
+    wparams.append("-u")
+    wparams.append(config.PORTAL_URI)
+
+    log.info("docker run %s %s" % (run.job_id, " ".join(wparams)))
+
+    # Set the list of ENVs to pass to the container.
+    # 1. MIST_GIT_CLONE_COMMAND is the git-clone command that will be used
+    #    by the container to clone the Git repo. Since the Git URL may
+    #    include Basic Auth, we do not want to have it returned by the API.
+    #    If possible, the repo is cloned out of the local mirror, which is
+    #    served by the API.
+    # 2. MIST_JOB_OUTPUT_URL is where the container should stream its output
+    #    to, as it is produced, with POST requests.
+    template = stack.template
+    if (GIT_MIRRORS_DIR and GIT_MIRROR_SERVE and
+            template.location_type == 'github'):
+        clone_command = template.get_git_mirror_clone_command(
+            '%s/api/v1/templates/%s/git' % (config.PORTAL_URI, template.id),
+            token.token)
+    else:
+        clone_command = template.git_clone_command
+    env = ['MIST_GIT_CLONE_COMMAND=%s' % clone_command,
+           'MIST_JOB_OUTPUT_URL=%s/api/v1/orchestration/jobs/%s/output' % (
+               config.PORTAL_URI, run.job_id)]
+
+    container_id = exec_in_pooled_container(run.job_id, wparams, env)
+    if not container_id:
+        container_id = docker_run(
+            name='orchestration-workflow-%s' % run.job_id,
+            image_id=CLOUDIFY_MIST_PLUGIN_IMAGE,
+            env=env, command=' '.join(wparams)).id
+
+    run.update(set__container_id=container_id)
+    # TODO deprecate container_id, store it in model
+    log_entry = {
+        'job_id': run.job_id,
+        'stack_id': stack.id,
+        'container_id': container_id,
+        'user_email': run.user.email,
+        'owner_id': run.owner.id,
+        'template_id': stack.template.id,
+        'workflow': run.workflow,
+        'inputs': run.inputs,
+        'setuid': run.setuid,
+    }
+    event = log_event(event_type='job', action='workflow_started', **log_entry)
+    # Only the most recent runs are summarized in the Stack, so that its size
+    # does not grow with every workflow.
+    Stack._get_collection().update_one({'_id': stack.id}, {
+        '$set': {
+            'status': ('start_creation' if run.workflow == 'install'
+                       else 'workflow_started'),
+            'container_id': container_id,
+        },
+        '$inc': {'version': 1},
+        '$push': {
+            'workflows': {
+                '$each': [{'name': run.workflow,
+                           'job_id': run.job_id,
+                           'timestamp': event['time'],
+                           'error': False}],
+                '$slice': -STACK_WORKFLOWS_SUMMARY_SIZE,
+            },
+        },
+    })
+    trigger_session_update(run.owner, ['stacks'])
+
+
+def exec_in_pooled_container(job_id, wparams, env):
+    """Run a workflow in an idle pooled container, if one is available.
+
+    Return the id of the container, or None, if no idle container could be
+    used. In any case, the pool is asked to refill.
+
+    """
+    if not WORKFLOW_CONTAINER_POOL_SIZE:
+        return None
+    from mist.orchestration import tasks
+    tasks.refill_container_pool.send()
+    while True:
+        pooled = PooledContainer.objects(status='idle').modify(
+            set__status='busy', set__job_id=job_id, unset__slot=True,
+            new=True)
+        if pooled is None:
+            log.warning('No idle pooled container for workflow %s', job_id)
+            return None
+        try:
+            docker_exec(pooled.container_id,
+                        CLOUDIFY_MIST_PLUGIN_ENTRYPOINT + wparams, env)
+        except Exception as exc:
+            log.error('Failed to run workflow %s in pooled container %s: %r',
+                      job_id, pooled.container_id, exc)
+            remove_pooled_container(pooled)
+            continue
+        return pooled.container_id
+
+
+def remove_pooled_container(pooled):
+    """Remove a pooled container, along with its record"""
+    # Containers, which are still starting, are only known by their name.
+    container = pooled.container_id or pooled.container_name
+    try:
+        docker_remove(container)
+    except Exception as exc:
+        log.warning('Failed to remove pooled container %s: %r',
+                    container, exc)
+    pooled.delete()
+
+
+def refill_container_pool():
+    """Start idle containers, until the pool is full.
+
+    Containers, whose workflow run is over, as well as containers that have
+    failed to start, are removed first. Free slots of the pool are reserved
+    atomically, so refills may run concurrently. Return the number of
+    containers started.
+
+    """
+    busy = {pooled.job_id: pooled
+            for pooled in PooledContainer.objects(status='busy')}
+    running = set(WorkflowRun.objects(job_id__in=list(busy),
+                                      status='running').scalar('job_id'))
+    for job_id, pooled in busy.items():
+        if job_id not in running:
+            remove_pooled_container(pooled)
+    for pooled in PooledContainer.objects(
+            status='starting',
+            created__lt=datetime.utcnow() - timedelta(minutes=10)):
+        remove_pooled_container(pooled)
+
+    started = 0
+    for slot in range(WORKFLOW_CONTAINER_POOL_SIZE):
+        try:
+            pooled = PooledContainer(slot=slot).save(force_insert=True)
+        except me.NotUniqueError:  # Occupied.
+            continue
+        try:
+            container_id = docker_create(
+                name=pooled.container_name,
+                image_id=CLOUDIFY_MIST_PLUGIN_IMAGE,
+                entrypoint=WORKFLOW_CONTAINER_IDLE_COMMAND)
+        except Exception as exc:
+            log.error('Failed to start pooled container: %r', exc)
+            remove_pooled_container(pooled)
+            break
+        pooled.update(set__container_id=container_id, set__status='idle')
+        started += 1
+    return started
+
+
+def append_workflow_output(job_id, data):
+    """Append `data` to the output of a workflow.
+
+    The offset of each chunk is reserved by atomically incrementing the
+    size of the output, so that concurrent appends never overlap. Return
+    the new size of the output.
+
+    """
+    end = 0
+    for i in range(0, len(data), WORKFLOW_OUTPUT_CHUNK_SIZE):
+        piece = data[i:i + WORKFLOW_OUTPUT_CHUNK_SIZE]
+        run = WorkflowRun.objects(job_id=job_id).only('output_size').modify(
+            inc__output_size=len(piece), new=True)
+        if run is None:
+            raise NotFoundError('Job %s not found' % job_id)
+        end = run.output_size
+        WorkflowOutputChunk(job_id=job_id, offset=end - len(piece), end=end,
+                            data=piece).save()
+    return end
+
+
+def iter_workflow_output(job_id, offset=0):
+    """Return the stored output of a workflow, starting at `offset`.
+
+    Yield (end, data) tuples, where `end` is the offset to resume from. Stop
+    at the first gap, which a concurrent append has yet to fill.
+
+    """
+    chunks = WorkflowOutputChunk.objects(job_id=job_id, end__gt=offset)
+    for chunk in chunks.order_by('end'):
+        if chunk.offset > offset:
+            break
+        yield chunk.end, chunk.data[offset - chunk.offset:]
+        offset = chunk.end
 
 
 def finish_workflow(stack, job_id, workflow, exit_code, cmdout, error,
-                    node_instances=None, outputs={}):
+                    node_instances=None, outputs={},
+                    updated_node_instances=None):
+    """Record the outcome of a workflow.
+
+    The Stack's node instances may be reported either in full, by means of
+    `node_instances`, which replaces the existing ones, or incrementally,
+    by means of `updated_node_instances`, which only includes the node
+    instances that changed during the workflow. In the latter case, only
+    the changed node instances are written to the database.
+
+    """
     prev_stack_status = stack.status
 
     if error:
@@ -199,11 +1050,21 @@ def finish_workflow(stack, job_id, workflow, exit_code, cmdout, error,
         'cmdout': cmdout,
         'error': error
     }
+    run = WorkflowRun.objects(job_id=job_id).only('output_size').modify(
+        set__status='error' if error else 'ok',
+        set__finished_at=datetime.utcnow(), set__exit_code=exit_code,
+        new=True)
+    # Streamed output is already stored in WorkflowOutputChunks.
+    if run is not None and run.output_size:
+        log_entry['cmdout'] = ''
+        log_entry['output_size'] = run.output_size
     log_event(event_type='job', action='workflow_finished', **log_entry)
     if error:
-        for wkfl in stack.workflows:
-            if workflow in wkfl and wkfl[workflow] == job_id:
-                wkfl['error'] = True
+        # mongoengine does not translate positional updates of the untyped
+        # dicts of `workflows`.
+        Stack._get_collection().update_one(
+            {'_id': stack.id, 'workflows.job_id': job_id},
+            {'$set': {'workflows.$.error': True}, '$inc': {'version': 1}})
     try:
         stack.save()
     except me.ValidationError as err:
@@ -214,11 +1075,142 @@ def finish_workflow(stack, job_id, workflow, exit_code, cmdout, error,
         log.error('%s is not unique: %s', stack, err)
         raise ConflictError('Stack "%s" already exists' % stack.name)
 
-    io_helpers.trigger_session_update(stack.owner.id, ['stacks'])
+    # Node instances are reset once the Stack is uninstalled.
+    if updated_node_instances and not stack.is_uninstalled:
+        stack.update_node_instances(sanitize_dict(updated_node_instances))
+
+    trigger_session_update(stack.owner.id, ['stacks'])
+
+    # Start any workflows waiting for this one to finish.
+    from mist.orchestration import tasks
+    tasks.dispatch_workflows.send()
+    if WORKFLOW_CONTAINER_POOL_SIZE:
+        tasks.refill_container_pool.send()
 
     return
 
 
+def _archive(document, query, exclude=None, callback=None):
+    """Move the documents matching `query` to the archive collection of
+    `document`, in batches. Return the ids of the archived documents.
+
+    `exclude`, if specified, is called with each batch of documents and
+    returns the ids of the ones, which must not be archived yet. `callback`,
+    if specified, is called with each batch of documents to be archived,
+    before they are removed.
+
+    """
+    collection = document._get_collection()
+    archive = collection.database['%s_archive' % collection.name]
+    archived, skipped = [], []
+    while True:
+        batch = list(collection.find(
+            dict(query, _id={'$nin': skipped}) if skipped else query,
+            limit=ARCHIVE_BATCH_SIZE))
+        if not batch:
+            return archived
+        if exclude is not None:
+            excluded = exclude(batch)
+            skipped.extend(excluded)
+            batch = [doc for doc in batch if doc['_id'] not in excluded]
+        ids = [doc['_id'] for doc in batch]
+        if batch:
+            # Documents may have been copied already, if an earlier run was
+            # interrupted, in which case they are replaced.
+            archive.bulk_write([ReplaceOne({'_id': doc['_id']}, doc,
+                                           upsert=True) for doc in batch],
+                               ordered=False)
+            if callback is not None:
+                callback(batch)
+            collection.delete_many({'_id': {'$in': ids}})
+            archived.extend(ids)
+
+
+def _remove_mappings(document, batch):
+    """Remove the RBAC mappings of the given documents, as their `delete`
+    method does, dereferencing each of their owners and users only once"""
+    owners = {owner.id: owner for owner in Owner.objects(
+        id__in=list({doc['owner'] for doc in batch if doc.get('owner')}))}
+    users = {user.id: user for user in User.objects(
+        id__in=list({doc['owned_by'] for doc in batch
+                     if doc.get('owned_by')}))}
+    for doc in batch:
+        owner = owners.get(doc.get('owner'))
+        if owner is None:
+            continue
+        resource = document._from_son(doc)
+        owner.mapper.remove(resource)
+        user = users.get(doc.get('owned_by'))
+        if user is not None:
+            user.get_ownership_mapper(owner).remove(resource)
+
+
+def archive_deleted():
+    """Archive the Templates and Stacks deleted before the retention period.
+
+    Stacks are deleted by uninstalling them, so Stacks whose last workflow
+    is an uninstall, which succeeded before the retention period, are
+    archived as well. Tags and RBAC mappings of archived resources are
+    removed, as well as the workflow runs and output of archived Stacks.
+    Templates are only archived, once none of their Stacks is left, since
+    Stacks keep using their Template. Owners of archived resources get a
+    single session update. Return the number of archived Templates and
+    Stacks.
+
+    """
+    if not ARCHIVE_RETENTION_DAYS:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_RETENTION_DAYS)
+    query = {'deleted': {'$lt': cutoff}}
+    changed = {}
+
+    # The summaries of workflows are timestamped with the time of their
+    # log event.
+    timestamp = time.time() - ARCHIVE_RETENTION_DAYS * 24 * 3600
+
+    def reinstalled(batch):
+        # Only Stacks, whose last workflow is the uninstall, are archived.
+        return {doc['_id'] for doc in batch if not doc.get('deleted') and (
+            not doc.get('workflows')
+            or doc['workflows'][-1].get('name') != 'uninstall'
+            or doc['workflows'][-1].get('error')
+            or doc['workflows'][-1].get('timestamp', timestamp) >= timestamp)}
+
+    def remove_stacks(batch):
+        ids = [doc['_id'] for doc in batch]
+        _remove_mappings(Stack, batch)
+        Tag.objects(resource_type='stack', resource_id__in=ids).delete()
+        job_ids = list(WorkflowRun.objects(stack__in=ids).scalar('job_id'))
+        WorkflowOutputChunk.objects(job_id__in=job_ids).delete()
+        WorkflowRun.objects(job_id__in=job_ids).delete()
+        for doc in batch:
+            changed.setdefault(doc.get('owner'), set()).add('stacks')
+
+    stack_ids = _archive(Stack, {'$or': [query, {
+        'deleted': None, 'status': 'ok',
+        'workflows': {'$elemMatch': {'name': 'uninstall', 'error': False,
+                                     'timestamp': {'$lt': timestamp}}},
+    }]}, exclude=reinstalled, callback=remove_stacks)
+
+    def in_use(batch):
+        return set(Stack._get_collection().distinct(
+            'template', {'template': {'$in': [doc['_id'] for doc in batch]}}))
+
+    def remove_templates(batch):
+        _remove_mappings(Template, batch)
+        Tag.objects(resource_type='template',
+                    resource_id__in=[doc['_id'] for doc in batch]).delete()
+        for doc in batch:
+            changed.setdefault(doc.get('owner'), set()).add('templates')
+
+    template_ids = _archive(Template, query, exclude=in_use,
+                            callback=remove_templates)
+    for owner_id, sections in changed.items():
+        if owner_id:
+            trigger_session_update(owner_id, sections)
+    return len(stack_ids) + len(template_ids)
+
+
 def get_workflows(parsed):
     workflows = []
     for workflow_name in parsed["workflows"]:
@@ -228,27 +1220,171 @@ def get_workflows(parsed):
     return workflows
 
 
-def analyze_template(template):
+def get_template_parse_error(exc):
+    """Return a user-friendly message out of an analysis exception"""
+    return str(exc).split('}')[-1].strip() or TemplateParseError.msg
+
+
+def get_template_analysis_key(digest, entrypoint=None):
+    """Return the key of a template analysis in the analysis cache.
+
+    `digest` should uniquely identify the contents of a blueprint, such as a
+    hash of the blueprint itself or a Git commit SHA. An empty key, which
+    disables caching, is returned if `digest` is missing.
+
+    """
+    if not digest:
+        return ''
+    key = '%s:%s:%s' % (TEMPLATE_ANALYSIS_VERSION, digest, entrypoint or '')
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_cached_template_analysis(key):
+    """Return the cached TemplateAnalysis stored under `key`, if any"""
+    if not key or not TEMPLATE_ANALYSIS_CACHE_SIZE:
+        return None
+    analysis = TemplateAnalysis.objects(id=key).modify(
+        inc__hits=1, set__last_used_at=datetime.utcnow(), new=True)
+    if analysis is None:
+        TEMPLATE_ANALYSIS_STATS['misses'] += 1
+    else:
+        TEMPLATE_ANALYSIS_STATS['hits'] += 1
+    log.debug('Template analysis cache %s for %s (hits=%d, misses=%d)',
+              'hit' if analysis else 'miss', key,
+              TEMPLATE_ANALYSIS_STATS['hits'],
+              TEMPLATE_ANALYSIS_STATS['misses'])
+    return analysis
+
+
+def cache_template_analysis(key, workflows, inputs):
+    """Store a template analysis and evict the least recently used ones"""
+    if not key or not TEMPLATE_ANALYSIS_CACHE_SIZE:
+        return
+    TemplateAnalysis(id=key, workflows=workflows, inputs=inputs).save()
+    stale = list(TemplateAnalysis.objects.order_by('-last_used_at').skip(
+        TEMPLATE_ANALYSIS_CACHE_SIZE).scalar('id'))
+    if stale:
+        log.debug('Evicting %d template analyses from cache', len(stale))
+        TemplateAnalysis.objects(id__in=stale).delete()
+
+
+def get_template_analysis_stats():
+    """Return statistics about the template analysis cache"""
+    stats = dict(TEMPLATE_ANALYSIS_STATS)
+    stats['size'] = TemplateAnalysis.objects.count()
+    stats['max_size'] = TEMPLATE_ANALYSIS_CACHE_SIZE
+    return stats
+
+
+def _analyze(template, key, parse, validate=False):
+    """Set the workflows and inputs of `template`.
+
+    The blueprint is parsed by calling `parse` only if no analysis is cached
+    under `key` or if it has to be validated.
+
+    """
+    analysis = None if validate else get_cached_template_analysis(key)
+    if analysis is not None:
+        template.workflows = analysis.workflows
+        template.inputs = analysis.inputs
+        return
+    parsed = parse()
+    template.workflows = get_workflows(parsed)
+    template.inputs = form_inputs(parsed["inputs"])
+    cache_template_analysis(key, template.workflows, template.inputs)
+
+
+def get_import_resolver():
+    """Return the resolver of blueprint imports used by the DSL parser"""
+    return CachedImportResolver(rules=IMPORT_RESOLVER_RULES,
+                                max_age=IMPORTS_MAX_AGE)
+
+
+def parse_blueprint(path=None, content=None, resolver=None, validate=False):
+    """Return the inputs and workflows of a blueprint
+
+    The blueprint is read from `path` or from its `content`. Unless it has to
+    be validated, only the relevant sections of the blueprint and its imports
+    are read, falling back to the DSL parser, which builds and validates the
+    entire plan, if that fails.
+
+    """
+    if not validate:
+        try:
+            return read_blueprint(path, content, resolver)
+        except Exception as exc:
+            log.debug('Falling back to the DSL parser for %s: %r',
+                      path or 'inline blueprint', exc)
+    if path:
+        return parser.parse_from_path(path, resolver=resolver)
+    return parser.parse(content, resolver=resolver)
+
+
+def analyze_template(template, validate=False):
+    """Set the workflows and inputs of `template`
+
+    If `validate` is set, the blueprint is always parsed and validated in
+    full, instead of reading just its inputs and workflows.
+
+    """
     if template.exec_type == 'cloudify':
+        resolver = get_import_resolver()
+        _parse = partial(parse_blueprint, resolver=resolver,
+                         validate=validate)
         if template.location_type == 'github':
-            with io_helpers.get_cloned_git_path(template.git_repo,
-                                                template.git_branch) as tmpdir:
-                path = find_path(tmpdir, template.entrypoint)
-                parsed = parser.parse_from_path(path)
+            if GIT_MIRRORS_DIR:
+                mirror = get_git_mirror(template.git_repo)
+                revision = get_git_mirror_revision(mirror,
+                                                   template.git_branch)
+                checkout = partial(checkout_git_mirror, mirror, revision)
+            else:
+                revision = get_git_revision(template.git_repo,
+                                            template.git_branch)
+                checkout = partial(io_helpers.get_cloned_git_path,
+                                   template.git_repo, template.git_branch)
+            if revision and revision not in template.versions:
+                template.versions.append(revision)
+
+            def parse():
+                with checkout() as tmpdir:
+                    path = find_path(tmpdir, template.entrypoint)
+                    return _parse(path)
+
+            key = get_template_analysis_key(revision, template.entrypoint)
+            _analyze(template, key, parse, validate)
         elif template.location_type == 'url':
-            tmpdir = tempfile.mkdtemp()
-            os.chdir(tmpdir)
-            path = download(template.template)
-            try:
-                unpack(path, tmpdir)
-                path = find_path(tmpdir, template.entrypoint)
-            except:
-                pass
-            parsed = parser.parse_from_path(path)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                dirname = os.path.join(tmpdir, 'blueprint')
+                # Where the blueprint is saved, if it is not an archive.
+                plain = os.path.join(tmpdir, 'download')
+                if DOWNLOADS_DIR:
+                    path = download(template.template)
+                    key = get_template_analysis_key(get_file_digest(path),
+                                                    template.entrypoint)
+
+                    def parse():
+                        return _parse(unpack_blueprint(
+                            path, dirname, template.entrypoint, plain))
+                else:
+                    # Without the downloads cache, the archive is streamed
+                    # and its digest is not known in advance.
+                    key = ''
+
+                    def parse():
+                        with urllib.request.urlopen(template.template,
+                                                    timeout=60) as response:
+                            entrypoint = unpack_blueprint(
+                                response, dirname, template.entrypoint, plain)
+                        return _parse(entrypoint)
+
+                _analyze(template, key, parse, validate)
         elif template.location_type == 'inline':
-            parsed = parser.parse(template.template)
-        template.workflows = get_workflows(parsed)
-        template.inputs = form_inputs(parsed["inputs"])
+            def parse():
+                return _parse(content=template.template)
+
+            key = get_template_analysis_key(
+                hashlib.sha256(template.template.encode()).hexdigest())
+            _analyze(template, key, parse, validate)
         return template
 
 
@@ -0,0 +1,136 @@
+"""One-off migrations of the orchestration plugin's data.
+
+Migrations are applied once per database, in the order of MIGRATIONS, and
+are recorded in the `orchestration_migration` collection. They must be
+applied on upgrade, before any requests are served or tasks are run, by
+means of `mist.orchestration.migrate` or by running this module:
+
+    python -m mist.orchestration.migrations
+
+Migrations work on the raw collections, so that mongoengine does not create
+the indexes of `mist.orchestration.models` before they are meant to be.
+
+"""
+import logging
+
+from datetime import datetime
+
+import mongoengine as me
+
+from pymongo import InsertOne
+
+from mist.orchestration.models import Template, Stack, WorkflowRun
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# Statuses of the last WorkflowRun of a Stack, by the status of the Stack.
+STACK_STATUSES = {
+    'start_creation': 'running',
+    'workflow_started': 'running',
+    'error': 'error',
+}
+
+
+def backfill_workflow_runs(db):
+    """Create the WorkflowRuns of the workflows summarized in Stacks.
+
+    Stacks used to keep every workflow they ran, which are now trimmed to
+    the most recent ones. The rest would be lost, unless copied first.
+
+    """
+    stacks = db[Stack._get_collection_name()]
+    runs = db[WorkflowRun._get_collection_name()]
+    requests = []
+    for stack in stacks.find({'workflows.job_id': {'$exists': True}},
+                             {'owner': 1, 'status': 1, 'workflows': 1}):
+        workflows = [workflow for workflow in stack['workflows']
+                     if workflow.get('job_id')]
+        existing = set(runs.distinct('_id', {
+            '_id': {'$in': [workflow['job_id'] for workflow in workflows]}}))
+        for i, workflow in enumerate(workflows):
+            if workflow['job_id'] in existing:
+                continue
+            # Only the status of the last workflow is reflected in the Stack.
+            status = 'ok'
+            if i == len(workflows) - 1:
+                status = STACK_STATUSES.get(stack.get('status'), 'ok')
+            if workflow.get('error'):
+                status = 'error'
+            created = datetime.utcfromtimestamp(workflow.get('timestamp') or 0)
+            run = {
+                '_id': workflow['job_id'],
+                'owner': stack['owner'],
+                'stack': stack['_id'],
+                'workflow': workflow.get('name'),
+                'setuid': False,
+                'status': status,
+                'created': created,
+                'started_at': created,
+                'output_size': 0,
+            }
+            if status != 'running':
+                run['finished_at'] = created
+            requests.append(InsertOne(run))
+        if len(requests) >= BATCH_SIZE:
+            runs.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        runs.bulk_write(requests, ordered=False)
+
+
+def drop_superseded_indexes(db):
+    """Drop the indexes of Templates and Stacks, which have been replaced,
+    and create the current ones.
+
+    A collection may only have a single text index, so the one on tags must
+    be dropped, before the one on names and descriptions may be created.
+    The listing indexes, which covered deleted documents too, are replaced
+    by partial ones.
+
+    """
+    superseded = [
+        [('owner', 1), ('deleted', 1), ('created', 1), ('_id', 1)],
+        [('owner', 1), ('deleted', 1), ('name', 1), ('_id', 1)],
+    ]
+    for document in (Template, Stack):
+        collection = db[document._get_collection_name()]
+        for index in list(collection.list_indexes()):
+            if list(index['key'].items()) in superseded or \
+                    'tags' in index.get('weights', {}):
+                log.info("Dropping index '%s' of '%s'.", index['name'],
+                         collection.name)
+                collection.drop_index(index['name'])
+        document.ensure_indexes()
+
+
+MIGRATIONS = [
+    ('0001_backfill_workflow_runs', backfill_workflow_runs),
+    ('0002_drop_superseded_indexes', drop_superseded_indexes),
+]
+
+
+def migrate(db=None):
+    """Apply the pending migrations. Return the names of the ones applied"""
+    if db is None:
+        db = me.get_db()
+    collection = db['orchestration_migration']
+    done = set(collection.distinct('_id'))
+    applied = []
+    for name, func in MIGRATIONS:
+        if name in done:
+            continue
+        log.info("Applying migration '%s'.", name)
+        func(db)
+        collection.insert_one({'_id': name, 'applied': datetime.utcnow()})
+        applied.append(name)
+    return applied
+
+
+if __name__ == '__main__':
+    # Importing mist.api connects to its database.
+    import mist.api  # noqa: F401
+    logging.basicConfig(level=logging.INFO)
+    for name in migrate():
+        print('Applied %s' % name)
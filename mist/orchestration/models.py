@@ -2,23 +2,95 @@
 from datetime import datetime
 from uuid import uuid4
 
-import json
+import shlex
+import posixpath
 import urllib.parse
 import mongoengine as me
+from pymongo import UpdateOne
 from mist.api.tag.models import Tag
-from mist.api.users.models import Owner
+from mist.api.users.models import Owner, User
 from mist.api.machines.models import Machine
 from mist.api.clouds.models import Cloud
 from mist.api.ownership.mixins import OwnershipMixin
 from mist.api.mongoengine_extras import MistDictField, MistListField
 from mist.api.tag.mixins import TagMixin
+from mist.orchestration.config import WORKFLOW_OUTPUT_TTL
+
+
+# NOTE: The indexes used to list Templates and Stacks only cover the ones,
+# which have not been deleted, so that they do not grow with the deleted ones.
+# Deleted Templates and Stacks are moved to archive collections eventually.
+# See `mist.orchestration.methods.archive_deleted`.
+# Tags live in the Tag collection, so the text indexes cover the names and
+# descriptions of Templates and Stacks. They are prefixed by the owner, which
+# every list query is scoped to.
+# Indexes, which have been replaced, are dropped by a migration, before the
+# current ones are created. See `mist.orchestration.migrations`.
+
+# NOTE: The `as_dict` methods read references, as well as untyped list and
+# dict fields, straight from `_data`. Accessing them as attributes makes
+# mongoengine dereference them, which, for untyped fields, means walking the
+# whole structure in search of references. This is slow for large
+# `node_instances` and `workflows`.
+
+
+class VersionMixin(object):
+    """Maintain the `version` field of a Document.
+
+    New documents are saved with version 1. Saving an existing document
+    increments its version atomically, so that every state of the document
+    has a version of its own, even when it is also updated by means of
+    `inc__version`. The in-memory version is incremented as well, which
+    only matches the stored one, if no other update took place in between.
+
+    """
+
+    def save(self, *args, **kwargs):
+        if self._created:
+            self.version = (self.version or 0) + 1
+            return super(VersionMixin, self).save(*args, **kwargs)
+        version = self.version or 0
+        self._version_incremented = False
+        ret = super(VersionMixin, self).save(*args, **kwargs)
+        if self._version_incremented:
+            self._data['version'] = version + 1
+        return ret
+
+    def _get_update_doc(self):
+        update_doc = super(VersionMixin, self)._get_update_doc()
+        if update_doc:
+            self._version_incremented = True
+            update_doc.get('$set', {}).pop('version', None)
+            update_doc.get('$unset', {}).pop('version', None)
+            update_doc = {key: value for key, value in update_doc.items()
+                          if value}
+            update_doc['$inc'] = {'version': 1}
+        return update_doc
+
+
+def _reference_id(document, name):
+    """Return the id of a document's reference, without dereferencing it"""
+    value = document._data.get(name)
+    return getattr(value, 'id', value)
+
+
+def _isoformat(value):
+    return str(value) if value else None
+
+
+def _project(d, fields):
+    """Return the subset of `d` requested in `fields`, along with its id"""
+    if not fields:
+        return d
+    return {key: value for key, value in d.items()
+            if key == 'id' or key in fields}
 
 
 class CloudifyContext(me.EmbeddedDocument):
     inputs = me.DictField()
 
 
-class Template(OwnershipMixin, me.Document, TagMixin):
+class Template(VersionMixin, OwnershipMixin, me.Document, TagMixin):
     id = me.StringField(primary_key=True,
                         default=lambda: uuid4().hex)
 
@@ -42,6 +114,14 @@ class Template(OwnershipMixin, me.Document, TagMixin):
 
     setuid = me.BooleanField(default=False)
 
+    # Templates may be analyzed asynchronously, in which case `workflows` and
+    # `inputs` are populated once the analysis is over.
+    status = me.StringField(default='ready',
+                            choices=('analyzing', 'ready', 'error'))
+    error = me.StringField()
+    # Incremented on every update of the Template.
+    version = me.IntField(default=0)
+
     meta = {
         'indexes': [
             {
@@ -50,10 +130,18 @@ class Template(OwnershipMixin, me.Document, TagMixin):
                 'unique': True,
                 'cls': False,
             }, {
-                'fields': ['$tags'],
+                'fields': ['owner', '$name', '$description'],
                 'default_language': 'english',
-                'sparse': True,
-                'unique': False
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
+            }, {
+                'fields': ['owner', 'created', 'id'],
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
+            }, {
+                'fields': ['owner', 'name', 'id'],
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
             }
         ],
     }
@@ -100,6 +188,22 @@ class Template(OwnershipMixin, me.Document, TagMixin):
                                                            self.git_repo)
         return ""
 
+    def get_git_mirror_clone_command(self, url, token):
+        """Return the git-clone command used to clone self from a mirror.
+
+        The mirror, which is located at `url`, is served over Git's dumb
+        HTTP protocol, which requires authentication with an API `token`.
+        The repository is cloned in a directory named after the origin
+        repository, as done by `git_clone_command`.
+
+        """
+        dirname = posixpath.basename(self.git_repo.rstrip("/"))
+        if dirname.endswith(".git"):
+            dirname = dirname[:-4]
+        return "git -c http.extraHeader=%s clone --branch %s %s %s" % (
+            shlex.quote("Authorization: %s" % token),
+            shlex.quote(self.git_branch), url, shlex.quote(dirname))
+
     def touch(self):
         self.last_used_at = datetime.utcnow()
 
@@ -110,23 +214,90 @@ class Template(OwnershipMixin, me.Document, TagMixin):
         if self.owned_by:
             self.owned_by.get_ownership_mapper(self.owner).remove(self)
 
-    def as_dict(self):
-        s = json.loads(self.to_json())
-        s["id"] = self.id
-        s["created"] = str(self.created)
-        s["owned_by"] = self.owned_by.id if self.owned_by else ""
-        s["created_by"] = self.created_by.id if self.created_by else ""
+    def as_dict(self, fields=None):
+        """Return a dict representation of self.
 
-        # Hide basic auth password.
-        if self.location_type == "github":
+        If `fields` is specified, only the requested fields are returned,
+        which allows to only load these from the database.
+
+        """
+        s = {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "owner": _reference_id(self, "owner"),
+            "exec_type": self.exec_type,
+            "location_type": self.location_type,
+            "template": self.template,
+            "entrypoint": self.entrypoint,
+            "created": str(self.created),
+            "last_used_at": _isoformat(self.last_used_at),
+            "versions": self.versions,
+            "workflows": self._data.get("workflows"),
+            "inputs": self._data.get("inputs"),
+            "deleted": _isoformat(self.deleted),
+            "setuid": self.setuid,
+            "status": self.status,
+            "error": self.error,
+            "owned_by": _reference_id(self, "owned_by") or "",
+            "created_by": _reference_id(self, "created_by") or "",
+        }
+
+        # Hide basic auth password. Also do so, if `location_type` has not
+        # been loaded due to a projection.
+        if self.template and self.location_type != "inline":
             password = urllib.parse.urlparse(self.template).password
             if password:
                 s["template"] = self.template.replace(password, "*password*")
 
-        return s
+        return _project(s, fields)
+
+
+class TemplateAnalysis(me.Document):
+    """The cached outcome of analyzing a Template.
+
+    Entries are keyed by a digest of the blueprint's contents, or by the Git
+    commit SHA for Templates stored in a Git repository, so that analyzing
+    the same blueprint twice yields the same entry, regardless of the owner.
+
+    """
+    id = me.StringField(primary_key=True)
+    workflows = MistListField()
+    inputs = MistListField()
+    created = me.DateTimeField(default=datetime.utcnow)
+    last_used_at = me.DateTimeField(default=datetime.utcnow)
+    hits = me.IntField(default=0)
+
+    meta = {
+        'indexes': ['last_used_at'],
+    }
+
+
+class CollectionVersion(me.Document):
+    """The version of an Owner's stacks or templates.
+
+    It is incremented whenever any of them changes, so that clients may tell
+    whether a list has changed without listing it again. The id is made of
+    the id of the Owner and the name of the collection.
+
+    """
+    id = me.StringField(primary_key=True)
+    version = me.IntField(default=0)
+
 
+class PendingSessionUpdate(me.Document):
+    """The sections of an Owner's session, which are due to be updated.
 
-class Stack(OwnershipMixin, me.Document, TagMixin):
+    Session updates triggered in quick succession are merged here, until
+    they are sent at once. The id is the id of the Owner.
+
+    """
+    id = me.StringField(primary_key=True)
+    sections = me.ListField(me.StringField())
+    created = me.DateTimeField(default=datetime.utcnow)
+
+
+class Stack(VersionMixin, OwnershipMixin, me.Document, TagMixin):
     """The basic Stack Model."""
     id = me.StringField(primary_key=True,
                         default=lambda: uuid4().hex)
@@ -142,6 +313,8 @@ class Stack(OwnershipMixin, me.Document, TagMixin):
     machines = me.ListField(
         me.ReferenceField(Machine, reverse_delete_rule=me.PULL))
     container_id = me.StringField()
+    # A summary of the most recent workflow runs. The full history is kept
+    # in the WorkflowRun collection.
     workflows = MistListField(me.DictField())
     template = me.ReferenceField(Template, reverse_delete_rule=me.NULLIFY)
     deploy = me.BooleanField(default=False)
@@ -149,6 +322,9 @@ class Stack(OwnershipMixin, me.Document, TagMixin):
     # keeping here for backwards compatibility.
     job_id = me.StringField()
     deleted = me.DateTimeField()
+    # Incremented on every update, so that concurrent modifications of the
+    # Stack can be detected.
+    version = me.IntField(default=0)
 
     meta = {
         'strict': False,
@@ -160,10 +336,26 @@ class Stack(OwnershipMixin, me.Document, TagMixin):
                 'unique': True,
                 'cls': False,
             }, {
-                'fields': ['$tags'],
+                'fields': ['owner', '$name', '$description'],
                 'default_language': 'english',
-                'sparse': True,
-                'unique': False
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
+            }, {
+                'fields': ['owner', 'created', 'id'],
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
+            }, {
+                'fields': ['owner', 'name', 'id'],
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
+            }, {
+                'fields': ['owner', 'status', 'created', 'id'],
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
+            }, {
+                'fields': ['owner', 'template', 'created', 'id'],
+                'partialFilterExpression': {'deleted': None},
+                'cls': False,
             }
         ],
     }
@@ -187,20 +379,90 @@ class Stack(OwnershipMixin, me.Document, TagMixin):
         if self.is_uninstalled:
             self.outputs, self.machines, self.node_instances = {}, [], []
 
-        if self.node_instances:
-            for instance in self.node_instances:
-                cloud_id = instance["runtime_properties"].get("cloud_id")
-                machine_id = instance["runtime_properties"].get("machine_id")
-                if cloud_id and machine_id:
-                    cloud = Cloud.objects.get(owner=self.owner, id=cloud_id,
-                                              deleted=None)
-                    machine = Machine.objects(cloud=cloud,
-                                              external_id=machine_id).first()
-                    if not machine:
-                        machine = Machine(cloud=cloud, external_id=machine_id)
-                        machine.save()
-                    if not (machine in self.machines):
-                        self.machines.append(machine)
+        # Machines only need to be resolved, if node instances changed.
+        if self.node_instances and (self._created or any(
+                field.split('.')[0] == 'node_instances'
+                for field in self._get_changed_fields())):
+            machine_ids = {machine.id for machine in self.machines}
+            for machine in self.resolve_machines(self.node_instances):
+                if machine.id not in machine_ids:
+                    machine_ids.add(machine.id)
+                    self.machines.append(machine)
+
+    def update_node_instances(self, node_instances):
+        """Atomically update the node instances included in `node_instances`.
+
+        Each node instance replaces the stored one with the same id, or is
+        appended, if no such node instance exists. Machines are resolved and
+        added to `self.machines`, as done by `clean`. All changes are sent
+        with a single bulk write, which only includes the given node
+        instances, rather than the whole Stack.
+
+        Note that `self` is not reloaded.
+
+        """
+        requests = []
+        # Keys are escaped, as when saving the whole Stack.
+        stored = self._fields['node_instances'].to_mongo(node_instances)
+        for instance in stored:
+            requests.append(UpdateOne(
+                {'_id': self.id, 'node_instances.id': instance['id']},
+                {'$set': {'node_instances.$': instance}}))
+            requests.append(UpdateOne(
+                {'_id': self.id, 'node_instances.id': {'$ne': instance['id']}},
+                {'$push': {'node_instances': instance}}))
+        machines = self.resolve_machines(node_instances)
+        if machines:
+            requests.append(UpdateOne(
+                {'_id': self.id},
+                {'$addToSet': {'machines': {
+                    '$each': [machine.id for machine in machines]}}}))
+        if requests:
+            requests.append(UpdateOne({'_id': self.id},
+                                      {'$inc': {'version': 1}}))
+            self._get_collection().bulk_write(requests, ordered=True)
+
+    def resolve_machines(self, node_instances):
+        """Return the Machines that correspond to `node_instances`.
+
+        Clouds and Machines are fetched with a single query each, regardless
+        of the number of node instances. Machines, which have not been polled
+        yet, are created one by one, so that mist.api's `Machine.save` and
+        its signals handle them, as any other new Machine. These are few.
+
+        """
+        keys = {}  # Used as an ordered set.
+        for instance in node_instances:
+            cloud_id = instance["runtime_properties"].get("cloud_id")
+            machine_id = instance["runtime_properties"].get("machine_id")
+            if cloud_id and machine_id:
+                keys[(cloud_id, machine_id)] = None
+        if not keys:
+            return []
+
+        cloud_ids = {cloud_id for cloud_id, _ in keys}
+        clouds = {cloud.id: cloud for cloud in Cloud.objects(
+            owner=self.owner, id__in=list(cloud_ids), deleted=None)}
+        if cloud_ids - set(clouds):
+            raise Cloud.DoesNotExist('Cloud %s does not exist' %
+                                     ', '.join(cloud_ids - set(clouds)))
+
+        machines = {}
+        for machine in Machine.objects(
+                cloud__in=list(clouds.values()),
+                external_id__in=list({machine_id for _, machine_id in keys})
+        ).no_dereference():
+            machines.setdefault((machine.cloud.id, machine.external_id),
+                                machine)
+
+        for cloud_id, machine_id in keys:
+            if (cloud_id, machine_id) not in machines:
+                machine = Machine(cloud=clouds[cloud_id],
+                                  external_id=machine_id)
+                machine.save()
+                machines[(cloud_id, machine_id)] = machine
+
+        return [machines[key] for key in keys]
 
     def delete(self):
         super(Stack, self).delete()
@@ -209,14 +471,175 @@ class Stack(OwnershipMixin, me.Document, TagMixin):
         if self.owned_by:
             self.owned_by.get_ownership_mapper(self.owner).remove(self)
 
-    def as_dict(self):
-        s = json.loads(self.to_json())
-        s.pop('container_id', None)
-        s["id"] = self.id
-        s["created"] = str(self.created)
-        s["owned_by"] = self.owned_by.id if self.owned_by else ""
-        s["created_by"] = self.created_by.id if self.created_by else ""
-        return s
+    def as_dict(self, fields=None):
+        """Return a dict representation of self.
+
+        If `fields` is specified, only the requested fields are returned,
+        which allows to only load these from the database.
+
+        """
+        s = {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "owner": _reference_id(self, "owner"),
+            "template": _reference_id(self, "template"),
+            "status": self.status,
+            "deploy": self.deploy,
+            "job_id": self.job_id,
+            "inputs": self._data.get("inputs"),
+            "outputs": self._data.get("outputs"),
+            "node_instances": self._data.get("node_instances"),
+            "machines": [getattr(machine, "id", machine)
+                         for machine in self._data.get("machines") or []],
+            "workflows": self._data.get("workflows"),
+            "created": str(self.created),
+            "deleted": _isoformat(self.deleted),
+            "owned_by": _reference_id(self, "owned_by") or "",
+            "created_by": _reference_id(self, "created_by") or "",
+        }
+        return _project(s, fields)
 
     def __str__(self):
         return '%s "%s"' % (self.__class__.__name__, self.name)
+
+
+class WorkflowRun(me.Document):
+    """A single execution of a workflow on a Stack.
+
+    Workflow runs are created in the `queued` state and are started by the
+    dispatcher, once the concurrency limits allow it. The primary key is the
+    id of the job.
+
+    """
+    job_id = me.StringField(primary_key=True, default=lambda: uuid4().hex)
+    owner = me.ReferenceField(Owner, required=True,
+                              reverse_delete_rule=me.CASCADE)
+    stack = me.ReferenceField(Stack, required=True,
+                              reverse_delete_rule=me.CASCADE)
+    user = me.ReferenceField(User)
+    workflow = me.StringField(required=True)
+    inputs = MistDictField()
+    setuid = me.BooleanField(default=False)
+    status = me.StringField(default='queued',
+                            choices=('queued', 'running', 'ok', 'error'))
+    container_id = me.StringField()
+    exit_code = me.IntField()
+    created = me.DateTimeField(default=datetime.utcnow)
+    started_at = me.DateTimeField()
+    finished_at = me.DateTimeField()
+    # Number of characters of output streamed by the workflow's container.
+    output_size = me.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {
+                'fields': ['status', 'created'],
+            }, {
+                'fields': ['status', 'owner'],
+            }, {
+                'fields': ['stack', '-created'],
+            }
+        ],
+    }
+
+    def as_dict(self):
+        """Return a dict representation of self"""
+        return {
+            "job_id": self.job_id,
+            "stack": _reference_id(self, "stack"),
+            "owner": _reference_id(self, "owner"),
+            "user": _reference_id(self, "user"),
+            "workflow": self.workflow,
+            "inputs": self._data.get("inputs"),
+            "setuid": self.setuid,
+            "status": self.status,
+            "error": self.status == 'error',
+            "exit_code": self.exit_code,
+            "created": str(self.created),
+            "started_at": _isoformat(self.started_at),
+            "finished_at": _isoformat(self.finished_at),
+            "output_size": self.output_size,
+        }
+
+    def __str__(self):
+        return '%s %s of %s' % (self.__class__.__name__, self.job_id,
+                                self.workflow)
+
+
+class WorkflowOutputChunk(me.Document):
+    """A piece of the output of a workflow's container.
+
+    Output is appended in chunks, as it is streamed by the container. Each
+    chunk covers the characters from `offset` up to, but excluding, `end`.
+
+    """
+    id = me.StringField(primary_key=True, default=lambda: uuid4().hex)
+    job_id = me.StringField(required=True)
+    offset = me.IntField(required=True)
+    end = me.IntField(required=True)
+    data = me.StringField(required=True)
+    created = me.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            {
+                'fields': ['job_id', 'end'],
+            }, {
+                'fields': ['created'],
+                'expireAfterSeconds': WORKFLOW_OUTPUT_TTL,
+            }
+        ],
+    }
+
+
+class WorkflowToken(me.Document):
+    """The API token most recently created for workflows of a Stack.
+
+    Tokens are reused by the workflows of the same Stack, User and setuid
+    flag, which is what the id is made of, for a while after they have been
+    created.
+
+    """
+    id = me.StringField(primary_key=True)
+    token_id = me.StringField(required=True)
+    created = me.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'indexes': ['created'],
+    }
+
+
+class PooledContainer(me.Document):
+    """A pre-started container of the cloudify-mist-plugin image.
+
+    Idle containers are handed workflow runs, instead of creating a new
+    container for every run. Each container is used for a single run and is
+    removed once the run is over.
+
+    Starting and idle containers occupy one of the numbered slots of the
+    pool, which are reserved by inserting them, so that concurrent refills
+    never exceed the size of the pool. Busy containers give up their slot.
+
+    """
+    id = me.StringField(primary_key=True, default=lambda: uuid4().hex)
+    container_id = me.StringField()
+    status = me.StringField(default='starting',
+                            choices=('starting', 'idle', 'busy'))
+    slot = me.IntField()
+    job_id = me.StringField()
+    created = me.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            'status', 'job_id', {
+                'fields': ['slot'],
+                'unique': True,
+                'partialFilterExpression': {'slot': {'$exists': True}},
+            }
+        ],
+    }
+
+    @property
+    def container_name(self):
+        return 'orchestration-pool-%s' % self.id
@@ -1 +1,90 @@
 """Tasks related to orchestration."""
+import logging
+
+from mist.api.dramatiq_app import dramatiq
+
+from mist.orchestration import methods
+from mist.orchestration.models import Template
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'analyze_template',
+    'dispatch_workflows',
+    'reap_workflow_runs',
+    'refill_container_pool',
+    'reap_workflow_tokens',
+    'archive_deleted',
+    'send_session_update',
+]
+
+
+@dramatiq.actor(queue_name='dramatiq_orchestration', max_retries=0)
+def analyze_template(template_id, validate=False):
+    """Analyze a Template, which has been saved in the `analyzing` state"""
+    try:
+        template = Template.objects.get(id=template_id, deleted=None)
+    except Template.DoesNotExist:
+        log.warning('Template %s was deleted before being analyzed',
+                    template_id)
+        return
+    try:
+        methods.analyze_template(template, validate=validate)
+    except Exception as exc:
+        log.error('Failed to analyze %s: %r', template, exc)
+        template.update(set__status='error',
+                        set__error=methods.get_template_parse_error(exc),
+                        inc__version=1)
+    else:
+        template.update(set__workflows=template.workflows,
+                        set__inputs=template.inputs,
+                        set__versions=template.versions,
+                        set__status='ready', unset__error=True,
+                        inc__version=1)
+    methods.trigger_session_update(template.owner, ['templates'])
+
+
+@dramatiq.actor(queue_name='dramatiq_orchestration', max_retries=0)
+def dispatch_workflows():
+    """Start queued workflows, as long as the concurrency limits allow"""
+    started = methods.dispatch_workflows()
+    if started:
+        log.info('Started %d queued workflows', started)
+
+
+@dramatiq.actor(queue_name='dramatiq_orchestration', max_retries=0)
+def reap_workflow_runs():
+    """Fail the running workflows, whose containers are gone"""
+    reaped = methods.reap_workflow_runs()
+    if reaped:
+        log.warning('Failed %d lost workflows', reaped)
+
+
+@dramatiq.actor(queue_name='dramatiq_orchestration', max_retries=0)
+def refill_container_pool():
+    """Replace used pooled containers with idle ones"""
+    started = methods.refill_container_pool()
+    if started:
+        log.info('Started %d pooled containers', started)
+
+
+@dramatiq.actor(queue_name='dramatiq_orchestration', max_retries=0)
+def archive_deleted():
+    """Archive the templates and stacks deleted before the retention period"""
+    archived = methods.archive_deleted()
+    if archived:
+        log.info('Archived %d deleted templates and stacks', archived)
+
+
+@dramatiq.actor(queue_name='dramatiq_orchestration', max_retries=0)
+def reap_workflow_tokens():
+    """Delete the expired API tokens of workflows"""
+    deleted = methods.reap_workflow_tokens()
+    if deleted:
+        log.info('Deleted %d expired workflow tokens', deleted)
+
+
+@dramatiq.actor(queue_name='dramatiq_orchestration', max_retries=0)
+def send_session_update(owner_id):
+    """Send the session updates merged during the debounce window"""
+    methods.send_session_update(owner_id)
@@ -1,13 +1,16 @@
+import os
+import json
+import codecs
 import logging
 import datetime
 import mongoengine as me
 
-from pyramid.response import Response
-
-from mist.api.helpers import trigger_session_update
+from pyramid.response import Response, FileResponse
+from pyramid.httpexceptions import HTTPNotModified
 
 from mist.api.helpers import view_config
 from mist.orchestration import methods
+from mist.orchestration import tasks
 from mist.api.auth.methods import auth_context_from_request
 from mist.api.helpers import params_from_request
 from mist.api.exceptions import NotFoundError
@@ -17,12 +20,15 @@ from mist.api.exceptions import BadRequestError
 from mist.api.exceptions import ConflictError
 
 from mist.api.tag.models import Tag
-from mist.api.tag.methods import add_tags_to_resource
 
 from mist.api.logs.methods import get_stories
 
-from mist.orchestration.models import Template, Stack
+from mist.orchestration.models import Template, Stack, WorkflowRun
 from mist.orchestration.exceptions import TemplateParseError
+from mist.orchestration.helpers import get_git_mirror
+from mist.orchestration.config import GIT_MIRRORS_DIR, GIT_MIRROR_SERVE
+from mist.orchestration.config import WORKFLOW_OUTPUT_CHUNK_SIZE
+from mist.orchestration.config import WORKFLOW_OUTPUT_POLL_INTERVAL
 
 from mist.api import config
 
@@ -30,12 +36,72 @@ log = logging.getLogger(__name__)
 
 OK = Response("OK", 200)
 
+# The files of a Git mirror, besides its objects, that are served over Git's
+# dumb HTTP protocol.
+GIT_DUMB_HTTP_FILES = ('HEAD', 'info/refs', 'info/packs')
+
 log = logging.getLogger(__name__)
 
 
+def _stream_json(resources):
+    """Encode an iterable of dicts as a JSON array, one item at a time"""
+    yield b'['
+    for i, resource in enumerate(resources):
+        yield (b',' if i else b'') + json.dumps(resource, default=str).encode()
+    yield b']'
+
+
+def _get_flag(params, key):
+    """Return the boolean value of a request parameter.
+
+    Query string parameters are strings, so "false", "0", "no" and "off" are
+    treated as False, as well as an empty value.
+
+    """
+    value = params.get(key)
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', 'false', '0', 'no', 'off')
+    return bool(value)
+
+
+def _not_modified(request, etag):
+    """Set the ETag of the response.
+
+    Return a 304 response, if the client already has this version of the
+    resource, or None otherwise.
+
+    """
+    request.response.etag = etag
+    if etag in request.if_none_match:
+        return HTTPNotModified(
+            headers={'ETag': request.response.headers['ETag']})
+    return None
+
+
+def _list_response(request, params, resources, limit=None):
+    """Return the response of a list endpoint.
+
+    The JSON array is streamed as `resources` are read from the database, if
+    the `stream` parameter is set. Otherwise, resources are rendered at once
+    and the X-Next-Cursor header is set to the value of the `after` parameter
+    of the next page, if any.
+
+    """
+    if _get_flag(params, 'stream'):
+        response = Response(app_iter=_stream_json(resources),
+                            content_type='application/json')
+        response.etag = request.response.etag
+        return response
+    resources = list(resources)
+    if limit and len(resources) == limit:
+        request.response.headers['X-Next-Cursor'] = resources[-1]['id']
+    return resources
+
+
 # SEC TODO add required permissions in docstring
 @view_config(route_name='api_v1_templates', request_method='POST',
              renderer='json')
+@methods.coalesce_session_updates
 def add_template(request):
     """
     Tags: orchestration
@@ -64,6 +130,13 @@ def add_template(request):
       required: true
     description:
       type: string
+    async:
+      type: boolean
+      description: Analyze the template in the background
+    validate:
+      type: boolean
+      description: Validate the entire blueprint, instead of only reading its
+        inputs and workflows
     """
     # SEC
     auth_context = auth_context_from_request(request)
@@ -102,10 +175,14 @@ def add_template(request):
 
     required_tags, _ = auth_context.check_perm('template', 'add', None)
     template = Template(owner=auth_context.owner, **kwargs)
-    try:
-        template = methods.analyze_template(template)
-    except Exception as e:
-        raise TemplateParseError(str(e).split('}')[-1].strip())
+    if _get_flag(params, 'async'):
+        template.status = 'analyzing'
+    else:
+        try:
+            template = methods.analyze_template(
+                template, validate=_get_flag(params, 'validate'))
+        except Exception as e:
+            raise TemplateParseError(methods.get_template_parse_error(e))
 
     # Set ownership.
     template.assign_to(auth_context.user)
@@ -124,23 +201,20 @@ def add_template(request):
     # SEC
     auth_context.org.mapper.update(template)
 
-    # FIXME: This is in an if/else statement, since required_tags may be None.
-    # Also, add_tags_to_resource may unnecessarily update the RBAC Mappings
-    # even with an empty tags dict. A trigger_session_update needs to be called
-    # explicitly, if not invoked from within add_tags_to_resource. WTF!
-    if required_tags:
-        add_tags_to_resource(auth_context.owner,
-                             [{'resource_type': 'template',
-                               'resource_id': template.id}],
-                             list(required_tags.items()))
-    else:
-        trigger_session_update(auth_context.owner, ['templates'])
+    methods.add_tags_to_resources(auth_context.owner, 'template',
+                                  [template.id], required_tags)
+    methods.trigger_session_update(auth_context.owner, ['templates'])
+
+    if template.status == 'analyzing':
+        tasks.analyze_template.send(template.id,
+                                    _get_flag(params, 'validate'))
 
     return template.as_dict()
 
 
 @view_config(route_name='api_v1_template', request_method='DELETE',
              renderer='json')
+@methods.coalesce_session_updates
 def delete_template(request):
     """
     Tags: orchestration
@@ -161,8 +235,9 @@ def delete_template(request):
     try:
         template = Template.objects.get(owner=auth_context.owner,
                                         id=template_id, deleted=None)
-        template.update(set__deleted=datetime.datetime.utcnow())
-        trigger_session_update(auth_context.owner, ['templates'])
+        template.update(set__deleted=datetime.datetime.utcnow(),
+                        inc__version=1)
+        methods.trigger_session_update(auth_context.owner, ['templates'])
     except Template.DoesNotExist:
         raise NotFoundError("Template not found")
     return OK
@@ -170,6 +245,7 @@ def delete_template(request):
 
 @view_config(route_name='api_v1_template', request_method='PUT',
              renderer='json')
+@methods.coalesce_session_updates
 def edit_template(request):
     """
     Tags: orchestration
@@ -200,8 +276,10 @@ def edit_template(request):
     try:
         template = Template.objects.get(owner=auth_context.owner,
                                         id=template_id, deleted=None)
-        template.update(set__name=template_name, set__description=template_description)
-        trigger_session_update(auth_context.owner, ['templates'])
+        template.update(set__name=template_name,
+                        set__description=template_description,
+                        inc__version=1)
+        methods.trigger_session_update(auth_context.owner, ['templates'])
     except Template.DoesNotExist:
         raise NotFoundError("Template not found")
     return OK
@@ -214,13 +292,59 @@ def list_templates(request):
     Tags: orchestration
     ---
     List user templates
+    ---
+    fields:
+      type: string
+      description: Comma-separated list of fields to return
+    sort:
+      type: string
+      description: Sort by created or name. Prefix with "-" for descending order
+    limit:
+      type: integer
+      description: Maximum number of results to return
+    after:
+      type: string
+      description: Return results after this id, as given by X-Next-Cursor
+    status:
+      type: string
+      description: Only return templates in this status
+    tag:
+      type: string
+      description: Comma-separated list of key or key=value tags, all of
+        which the templates must have
+    created_after:
+      type: string
+      description: Only return templates created at or after this ISO 8601 date
+    created_before:
+      type: string
+      description: Only return templates created before this ISO 8601 date
+    name_prefix:
+      type: string
+      description: Only return templates whose name starts with this prefix
+    search:
+      type: string
+      description: Only return templates whose name or description contain
+        these words
+    stream:
+      type: boolean
+      description: Stream the results, as they are read from the database
     """
 
     # SEC
     auth_context = auth_context_from_request(request)
     # /SEC
     auth_context.check_perm('template', 'read', None)
-    return methods.filter_list_templates(auth_context)
+    params = params_from_request(request)
+    fields = methods.parse_fields(params.get('fields'))
+    kwargs = methods.parse_list_params(params)
+    kwargs['filters'] = methods.parse_filter_params(params, 'template')
+    not_modified = _not_modified(
+        request, methods.get_list_etag(auth_context, 'template', params))
+    if not_modified:
+        return not_modified
+    templates = methods.iter_list_templates(auth_context, fields=fields,
+                                            **kwargs)
+    return _list_response(request, params, templates, kwargs['limit'])
 
 
 # SEC TODO add required permissions to docstring
@@ -230,11 +354,59 @@ def list_stacks(request):
     Tags: orchestration
     ---
     List user stacks
+    ---
+    fields:
+      type: string
+      description: Comma-separated list of fields to return
+    sort:
+      type: string
+      description: Sort by created or name. Prefix with "-" for descending order
+    limit:
+      type: integer
+      description: Maximum number of results to return
+    after:
+      type: string
+      description: Return results after this id, as given by X-Next-Cursor
+    status:
+      type: string
+      description: Only return stacks in this status
+    template:
+      type: string
+      description: Only return stacks created from this template
+    tag:
+      type: string
+      description: Comma-separated list of key or key=value tags, all of
+        which the stacks must have
+    created_after:
+      type: string
+      description: Only return stacks created at or after this ISO 8601 date
+    created_before:
+      type: string
+      description: Only return stacks created before this ISO 8601 date
+    name_prefix:
+      type: string
+      description: Only return stacks whose name starts with this prefix
+    search:
+      type: string
+      description: Only return stacks whose name or description contain
+        these words
+    stream:
+      type: boolean
+      description: Stream the results, as they are read from the database
     """
     auth_context = auth_context_from_request(request)
     # SEC
     auth_context.check_perm('stack', 'read', None)
-    return methods.filter_list_stacks(auth_context)
+    params = params_from_request(request)
+    fields = methods.parse_fields(params.get('fields'))
+    kwargs = methods.parse_list_params(params)
+    kwargs['filters'] = methods.parse_filter_params(params, 'stack')
+    not_modified = _not_modified(
+        request, methods.get_list_etag(auth_context, 'stack', params))
+    if not_modified:
+        return not_modified
+    stacks = methods.iter_list_stacks(auth_context, fields=fields, **kwargs)
+    return _list_response(request, params, stacks, kwargs['limit'])
 
 
 # SEC TODO add required permissions to docstring
@@ -244,58 +416,111 @@ def show_template(request):
     Tags: orchestration
     ---
     Show template details and job history
+    ---
+    fields:
+      type: string
+      description: Comma-separated list of fields to return
     """
     auth_context = auth_context_from_request(request)
+    params = params_from_request(request)
 
     template_id = request.matchdict['template_id']
+    fields = methods.parse_fields(params.get('fields'))
 
     # SEC
     auth_context.check_perm('template', 'read', template_id)
 
+    etag = methods.get_etag(Template, auth_context.owner, template_id, fields)
+    if etag is None:
+        raise NotFoundError("Template not found")
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
     try:
-        template = Template.objects.get(owner=auth_context.owner,
-                                        id=template_id, deleted=None)
+        template = methods.project(Template.objects, fields).get(
+            owner=auth_context.owner, id=template_id, deleted=None)
     except:
         raise NotFoundError("Template not found")
-    return template.as_dict()
+    return template.as_dict(fields)
 
 
-# SEC FIXME document permissions in docstring
-@view_config(route_name='api_v1_stacks', request_method='POST', renderer='json')
-def create_stack(request):
+@view_config(route_name='api_v1_template_git', request_method='GET')
+def get_template_git_file(request):
     """
     Tags: orchestration
     ---
-    Start a template job to run the template
+    Serve the local mirror of a template's Git repository over Git's dumb
+    HTTP protocol. Used by workflow containers to clone the template
+    ---
+    template_id:
+      type: string
+      required: true
     """
     auth_context = auth_context_from_request(request)
+    template_id = request.matchdict['template_id']
 
     # SEC
-    stack_tags, _ = auth_context.check_perm('stack', 'create', None)
+    auth_context.check_perm('template', 'read', template_id)
 
-    params = request.json_body
-    template_id = params.get('template_id')
-    stack_name = params.get('name')
-    stack_description = params.get('description')
-    deploy = params.get("deploy")
-    if not stack_name:
-        raise RequiredParameterMissingError("name")
-    if not template_id:
-        raise RequiredParameterMissingError("template_id")
+    if not (GIT_MIRRORS_DIR and GIT_MIRROR_SERVE):
+        raise NotFoundError("Git mirrors are disabled")
+    # Deleted templates are served, since their stacks may still run
+    # workflows.
+    try:
+        template = Template.objects.get(owner=auth_context.owner,
+                                        id=template_id)
+    except Template.DoesNotExist:
+        raise NotFoundError("Template not found")
+    if template.location_type != 'github':
+        raise NotFoundError("Template is not stored in a Git repository")
+
+    # Clones start by requesting the refs, which is when the mirror should
+    # be brought up to date.
+    subpath = '/'.join(request.matchdict['subpath'])
+    # Only the files needed by the dumb HTTP protocol are served. Others,
+    # such as the mirror's config, are private.
+    if subpath not in GIT_DUMB_HTTP_FILES and \
+            not subpath.startswith('objects/'):
+        raise NotFoundError("File not found")
+    mirror = get_git_mirror(template.git_repo,
+                            refresh=subpath == 'info/refs')
+    path = os.path.normpath(os.path.join(mirror, subpath))
+    if subpath not in GIT_DUMB_HTTP_FILES and \
+            not path.startswith(os.path.join(mirror, 'objects', '')):
+        raise NotFoundError("File not found")
+    if not os.path.isfile(path):
+        raise NotFoundError("File not found")
+    return FileResponse(path, request=request,
+                        content_type='application/octet-stream')
+
+
+def _get_template_to_apply(auth_context, template_id):
+    """Return the Template, which new stacks are to be created from"""
     try:
         template = Template.objects.get(owner=auth_context.owner,
                                         id=template_id, deleted=None)
     except:
         raise NotFoundError("Template not found")
+    if template.status == 'analyzing':
+        raise BadRequestError('Template "%s" is still being analyzed' %
+                              template.name)
+    if template.status == 'error':
+        raise BadRequestError('Template "%s" failed to be analyzed: %s' %
+                              (template.name, template.error))
 
     # SEC
     auth_context.check_perm("template", "apply", template_id)
-    stack = Stack(owner=auth_context.owner, template=template,
-                  name=stack_name, description=stack_description)
-    # /SEC
+    return template
 
-    ret = {}
-    inputs = params.get("inputs")
+
+def _prepare_stack_inputs(template, template_tags, inputs):
+    """Return the inputs of the install workflow of a new stack.
+
+    `template_tags` are the tags of the Template, which are propagated to the
+    stack, if appropriate.
+
+    """
+    inputs = inputs or {}
     template_inputs = [i.get('name') for i in template.inputs]
 
     # Process tags. Propagate the Template's tags, if appropriate.
@@ -309,8 +534,7 @@ def create_stack(request):
                                       'single-item dictionaries')
             tags = {key: value for t in tags for key, value in t.items()}
 
-        tags.update({t.key: t.value for t in Tag.objects(
-            resource_type='template', resource_id=template.id)})
+        tags.update(template_tags)
         inputs['mist_tags'] = tags
 
         for i in inputs:
@@ -319,6 +543,48 @@ def create_stack(request):
 
     if 'mist_uri' in template_inputs:
         inputs['mist_uri'] = config.PORTAL_URI
+    return inputs
+
+
+def _get_template_tags(template):
+    return {t.key: t.value for t in Tag.objects(
+        resource_type='template', resource_id=template.id)}
+
+
+# SEC FIXME document permissions in docstring
+@view_config(route_name='api_v1_stacks', request_method='POST', renderer='json')
+@methods.coalesce_session_updates
+def create_stack(request):
+    """
+    Tags: orchestration
+    ---
+    Start a template job to run the template
+    """
+    auth_context = auth_context_from_request(request)
+
+    # SEC
+    stack_tags, _ = auth_context.check_perm('stack', 'create', None)
+
+    params = request.json_body
+    template_id = params.get('template_id')
+    stack_name = params.get('name')
+    stack_description = params.get('description')
+    deploy = params.get("deploy")
+    if not stack_name:
+        raise RequiredParameterMissingError("name")
+    if not template_id:
+        raise RequiredParameterMissingError("template_id")
+    template = _get_template_to_apply(auth_context, template_id)
+
+    stack = Stack(owner=auth_context.owner, template=template,
+                  name=stack_name, description=stack_description)
+
+    inputs = params.get("inputs")
+    if inputs and 'mist_tags' in inputs:
+        template_tags = _get_template_tags(template)
+    else:
+        template_tags = {}
+    inputs = _prepare_stack_inputs(template, template_tags, inputs)
 
     stack.deploy = deploy
 
@@ -328,10 +594,8 @@ def create_stack(request):
     ret = stack.as_dict()
 
     if stack_tags:
-        add_tags_to_resource(auth_context.owner,
-                             [{'resource_type': 'stack',
-                               'resource_id': stack.id}],
-                             stack_tags)
+        methods.add_tags_to_resources(auth_context.owner, 'stack',
+                                      [stack.id], stack_tags)
         stack.save()
 
     job_id = methods.run_workflow(auth_context, stack,
@@ -342,12 +606,91 @@ def create_stack(request):
     # SEC
     auth_context.org.mapper.update(stack)
 
-    trigger_session_update(auth_context.owner, ['stacks'])
+    methods.trigger_session_update(auth_context.owner, ['stacks'])
+    return ret
+
+
+@view_config(route_name='api_v1_template_stacks', request_method='POST',
+             renderer='json')
+@methods.coalesce_session_updates
+def create_stacks(request):
+    """
+    Tags: orchestration
+    ---
+    Create many stacks from a template at once. The template and the
+    permissions are resolved once, all stacks are inserted with a single
+    write and their install workflows are queued together
+    ---
+    template_id:
+      type: string
+      required: true
+    stacks:
+      type: array
+      required: true
+      description: The stacks to create, each given as an object with a
+        name, an optional description and optional inputs
+    deploy:
+      type: boolean
+    """
+    auth_context = auth_context_from_request(request)
+
+    # SEC
+    stack_tags, _ = auth_context.check_perm('stack', 'create', None)
+
+    params = request.json_body
+    template_id = request.matchdict['template_id']
+    stack_params = params.get('stacks')
+    if not stack_params:
+        raise RequiredParameterMissingError('stacks')
+    if not isinstance(stack_params, list) or \
+            not all(isinstance(sp, dict) for sp in stack_params):
+        raise BadRequestError('Expecting a list of stacks')
+    if len(stack_params) > methods.MAX_BULK_SIZE:
+        raise BadRequestError('At most %d stacks may be created at once' %
+                              methods.MAX_BULK_SIZE)
+    for sp in stack_params:
+        if not sp.get('name'):
+            raise RequiredParameterMissingError('name')
+    template = _get_template_to_apply(auth_context, template_id)
+
+    if any(sp.get('inputs') and 'mist_tags' in sp['inputs']
+           for sp in stack_params):
+        template_tags = _get_template_tags(template)
+    else:
+        template_tags = {}
+
+    stacks, inputs = [], []
+    for sp in stack_params:
+        stack = Stack(owner=auth_context.owner, template=template,
+                      name=sp['name'], description=sp.get('description'),
+                      deploy=params.get('deploy'))
+        # Set ownership.
+        stack.assign_to(auth_context.user)
+        stacks.append(stack)
+        inputs.append(_prepare_stack_inputs(template, template_tags,
+                                            sp.get('inputs')))
+
+    job_ids = methods.run_workflows(auth_context, stacks, "install", inputs)
+
+    methods.add_tags_to_resources(auth_context.owner, 'stack',
+                                  [stack.id for stack in stacks], stack_tags)
+
+    # SEC
+    for stack in stacks:
+        auth_context.org.mapper.update(stack)
+
+    methods.trigger_session_update(auth_context.owner, ['stacks'])
+    ret = []
+    for stack, job_id in zip(stacks, job_ids):
+        sdict = stack.as_dict()
+        sdict['job_id'] = job_id
+        ret.append(sdict)
     return ret
 
 
 # SEC FIXME implement & document permission checks
 @view_config(route_name='api_v1_stack', request_method='POST', renderer='json')
+@methods.coalesce_session_updates
 def run_workflow(request):
     """
     Tags: orchestration
@@ -372,13 +715,66 @@ def run_workflow(request):
     ret["job_id"] = methods.run_workflow(auth_context, stack,
                                          workflow, inputs)
 
-    trigger_session_update(auth_context.owner, ['stacks'])
+    methods.trigger_session_update(auth_context.owner, ['stacks'])
 
     return ret
 
 
+@view_config(route_name='api_v1_stacks_workflows', request_method='POST',
+             renderer='json')
+@methods.coalesce_session_updates
+def run_workflows(request):
+    """
+    Tags: orchestration
+    ---
+    Run a workflow on many stacks at once. Returns the job id of each stack,
+    or null for any stacks, which were modified concurrently and should be
+    retried
+    ---
+    stack_ids:
+      type: array
+      required: true
+    workflow:
+      type: string
+      required: true
+    inputs:
+      type: object
+      description: The inputs of the workflow, common to all stacks
+    """
+    auth_context = auth_context_from_request(request)
+    params = request.json_body
+    stack_ids = params.get('stack_ids')
+    workflow = params.get('workflow')
+    if not stack_ids:
+        raise RequiredParameterMissingError('stack_ids')
+    if not workflow:
+        raise RequiredParameterMissingError('workflow')
+    if not isinstance(stack_ids, list):
+        raise BadRequestError('Expecting a list of stack ids')
+    if len(stack_ids) > methods.MAX_BULK_SIZE:
+        raise BadRequestError('At most %d stacks may be run at once' %
+                              methods.MAX_BULK_SIZE)
+    stacks = {stack.id: stack for stack in Stack.objects(
+        owner=auth_context.owner, id__in=stack_ids, deleted=None)}
+    missing = [stack_id for stack_id in stack_ids if stack_id not in stacks]
+    if missing:
+        raise NotFoundError("Stacks not found: %s" % ', '.join(missing))
+    stacks = [stacks[stack_id] for stack_id in dict.fromkeys(stack_ids)]
+    if workflow == "install":
+        for stack in stacks:
+            stack.deploy = True
+    inputs = params.get("inputs", None)
+    job_ids = methods.run_workflows(auth_context, stacks, workflow,
+                                    [inputs] * len(stacks))
+
+    methods.trigger_session_update(auth_context.owner, ['stacks'])
+
+    return {'job_ids': dict(zip([stack.id for stack in stacks], job_ids))}
+
+
 # SEC FIXME document permission checks
 @view_config(route_name='api_v1_stack', request_method='DELETE', renderer='json')
+@methods.coalesce_session_updates
 def delete_stack(request):
     """
     Tags: orchestration
@@ -401,7 +797,7 @@ def delete_stack(request):
     ret = {}
     ret["job_id"] = methods.run_workflow(auth_context, stack,
                                          "uninstall", inputs)
-    trigger_session_update(auth_context.owner, ['stacks'])
+    methods.trigger_session_update(auth_context.owner, ['stacks'])
 
     return ret
 
@@ -413,18 +809,218 @@ def show_stack(request):
     Tags: orchestration
     ---
     Start a template job to run the template
+    ---
+    fields:
+      type: string
+      description: Comma-separated list of fields to return
     """
     auth_context = auth_context_from_request(request)
     params = params_from_request(request)
     stack_id = request.matchdict["stack_id"]
+    fields = methods.parse_fields(params.get('fields'))
 
     # SEC
     auth_context.check_perm('stack', 'read', stack_id)
+    etag = methods.get_etag(Stack, auth_context.owner, stack_id, fields)
+    if etag is None:
+        raise NotFoundError("Stack not found")
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
     try:
-        stack = Stack.objects.get(owner=auth_context.owner,
-                                  id=stack_id, deleted=None)
+        stack = methods.project(Stack.objects, fields).get(
+            owner=auth_context.owner, id=stack_id, deleted=None)
     except:
         raise NotFoundError("Stack not found")
     inputs = params.get("inputs", {})
 
-    return stack.as_dict()
+    return stack.as_dict(fields)
+
+
+@view_config(route_name='api_v1_stack_workflows', request_method='GET',
+             renderer='json')
+def list_stack_workflows(request):
+    """
+    Tags: orchestration
+    ---
+    List the workflows run on a stack, most recent first
+    ---
+    stack_id:
+      type: string
+      required: true
+    limit:
+      type: integer
+      description: Maximum number of results to return
+    after:
+      type: string
+      description: Return results after this job id, as given by X-Next-Cursor
+    """
+    auth_context = auth_context_from_request(request)
+    params = params_from_request(request)
+    stack_id = request.matchdict["stack_id"]
+    kwargs = methods.parse_list_params(params)
+
+    # SEC
+    auth_context.check_perm('stack', 'read', stack_id)
+    try:
+        stack = Stack.objects.only('id').get(owner=auth_context.owner,
+                                             id=stack_id, deleted=None)
+    except Stack.DoesNotExist:
+        raise NotFoundError("Stack not found")
+    runs = methods.list_workflow_runs(stack, limit=kwargs['limit'],
+                                      after=kwargs['after'])
+    if kwargs['limit'] and len(runs) == kwargs['limit']:
+        request.response.headers['X-Next-Cursor'] = runs[-1]['job_id']
+    return runs
+
+
+@view_config(route_name='api_v1_orchestration_job', request_method='GET',
+             renderer='json')
+def show_job(request):
+    """
+    Tags: orchestration
+    ---
+    Show the stack, workflow, status, timestamps and exit code of a job
+    ---
+    job_id:
+      type: string
+      required: true
+    """
+    auth_context = auth_context_from_request(request)
+    job_id = request.matchdict['job_id']
+    runs = methods.get_workflow_runs(auth_context, [job_id])
+    if job_id not in runs:
+        raise NotFoundError("Job not found")
+    return runs[job_id]
+
+
+@view_config(route_name='api_v1_orchestration_jobs', request_method='GET',
+             renderer='json')
+def list_jobs(request):
+    """
+    Tags: orchestration
+    ---
+    Show many jobs at once. Jobs, which do not exist or are not visible, are
+    omitted from the response
+    ---
+    ids:
+      type: string
+      required: true
+      description: Comma-separated list of job ids
+    """
+    auth_context = auth_context_from_request(request)
+    params = params_from_request(request)
+    job_ids = [job_id for job_id in (params.get('ids') or '').split(',')
+               if job_id]
+    if not job_ids:
+        raise RequiredParameterMissingError('ids')
+    return methods.get_workflow_runs(auth_context, job_ids)
+
+
+def _get_job(auth_context, job_id):
+    runs = methods.get_workflow_runs(auth_context, [job_id])
+    if job_id not in runs:
+        raise NotFoundError("Job not found")
+    return runs[job_id]
+
+
+@view_config(route_name='api_v1_orchestration_job_output',
+             request_method='POST', renderer='json')
+def append_job_output(request):
+    """
+    Tags: orchestration
+    ---
+    Append to the output of a job. Used by workflow containers to stream
+    their output, as it is produced. The body, which may be sent with
+    chunked transfer encoding, is the output as UTF-8 text
+    ---
+    job_id:
+      type: string
+      required: true
+    """
+    auth_context = auth_context_from_request(request)
+    job_id = request.matchdict['job_id']
+    job = _get_job(auth_context, job_id)
+
+    # SEC
+    auth_context.check_perm('stack', 'run_workflow', job['stack'])
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    size = job['output_size']
+    while True:
+        block = request.body_file.read(WORKFLOW_OUTPUT_CHUNK_SIZE)
+        data = decoder.decode(block, final=not block)
+        if data:
+            size = methods.append_workflow_output(job_id, data)
+        if not block:
+            break
+    return {'output_size': size}
+
+
+def _read_job_output(job_id, offset):
+    """Return the output of a job after `offset`, the offset to resume from
+    and the status of the job.
+
+    Return right away, with whatever output is available. Clients wait for
+    more by polling.
+
+    """
+    # Output is stored before the job finishes, so it is all read, once the
+    # job is found to have finished.
+    status = WorkflowRun.objects(job_id=job_id).scalar('status').first()
+    chunks = list(methods.iter_workflow_output(job_id, offset))
+    return chunks, chunks[-1][0] if chunks else offset, status
+
+
+@view_config(route_name='api_v1_orchestration_job_output',
+             request_method='GET')
+def show_job_output(request):
+    """
+    Tags: orchestration
+    ---
+    Return the output of a job after the given offset, which is available so
+    far. Returns server-sent events, whose ids are the offsets to resume
+    from, if requested with "Accept: text/event-stream", or plain text
+    otherwise, along with the X-Next-Offset header. Clients tail the output
+    by polling, as advised by the retry field or the Retry-After header,
+    until the X-Job-Status header, or the end event, shows that the job has
+    finished
+    ---
+    job_id:
+      type: string
+      required: true
+    offset:
+      type: integer
+      description: Number of characters of output to skip. Defaults to the
+        Last-Event-ID header of server-sent events or 0
+    """
+    auth_context = auth_context_from_request(request)
+    params = params_from_request(request)
+    job_id = request.matchdict['job_id']
+    _get_job(auth_context, job_id)
+
+    try:
+        offset = int(params.get('offset') or
+                     request.headers.get('Last-Event-ID') or 0)
+    except (TypeError, ValueError):
+        raise BadRequestError('The offset must be an integer')
+    sse = 'text/event-stream' in request.headers.get('Accept', '')
+    chunks, offset, status = _read_job_output(job_id, max(offset, 0))
+    if sse:
+        # EventSource reconnects with the Last-Event-ID after `retry` ms.
+        body = ['retry: %d\n' % (WORKFLOW_OUTPUT_POLL_INTERVAL * 1000)]
+        for end, data in chunks:
+            body.append('id: %d\n%s\n' % (end, ''.join(
+                'data: %s\n' % line for line in data.split('\n'))))
+        if status in ('ok', 'error'):
+            body.append('event: end\ndata: %s\n\n' % status)
+    else:
+        body = [data for _, data in chunks]
+    headers = {'Cache-Control': 'no-cache', 'X-Next-Offset': str(offset),
+               'X-Job-Status': str(status)}
+    if status not in ('ok', 'error'):
+        headers['Retry-After'] = str(WORKFLOW_OUTPUT_POLL_INTERVAL)
+    return Response(
+        ''.join(body),
+        content_type='text/event-stream' if sse else 'text/plain',
+        charset='utf-8', headers=headers)